@@ -0,0 +1,393 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import PIL.Image
+from PIL import ImageFont
+from imgfactory import ImgFactory, RenderPool
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SAMPLE = os.path.join(ROOT, "TestData", "SampleImage.jpg")
+
+# (bgDim, fgDim) of each benchmarked resolution
+RESOLUTIONS = {
+    "icon": ((28, 52), (24, 24)),
+    "banner": ((248, 682), (200, 200)),
+    "4k": ((2160, 3840), (1080, 1080)),
+}
+# max difference of a pixel channel (0 - 255) between the reduced and the full decode, see checkReducedDecode
+REDUCED_DECODE_TOLERANCE = 8
+STAGES = ("readBg", "renderImg", "combineImg", "addText", "getTextImg", "getFocusedFg", "dumpImg")
+
+# run in a fresh interpreter by measureStartup, printing the seconds to import imgfactory and to the first renderImg
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import numpy as np
+from imgfactory import ImgFactory
+imported = time.perf_counter() - start
+ImgFactory((28, 52), (24, 24)).renderImg(np.ones([28, 52, 4]), (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), 3)
+rendered = time.perf_counter() - start
+try:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+except ImportError:
+    peak = 0
+print(json.dumps({"import": imported, "renderImg": rendered, "peakBytes": peak, "modules": sorted(name for name in ("cv2", "PIL", "matplotlib") if name in sys.modules)}))
+"""
+
+def makeInputs(_dirPath, _seed):
+    """
+    Parameters
+    ----------
+    _dirPath: string
+        Directory of the synthetic images
+    _seed: int
+        Seed of the random generator
+    Returns
+    ----------
+    Dict
+        Paths of the inputs, "bg" (jpg), "dct" and "fg" (png with alpha) and "sample" (TestData/SampleImage.jpg)
+    """
+    rng = np.random.default_rng(_seed)
+    rows, cols = np.mgrid[0:1080, 0:1920]
+    bg = np.dstack([cols * 255 // 1919, rows * 255 // 1079, rng.integers(0, 256, [1080, 1920])]).astype(np.uint8)
+    dct = np.zeros([1080, 1920, 4], dtype = np.uint8)
+    dct[:, :, :3] = rng.integers(0, 256, [1080, 1920, 3])
+    dct[100:400, 200:900, 3] = 255
+    dct[700:1000, 1100:1800, 3] = 160
+    fg = np.zeros([800, 800, 4], dtype = np.uint8)
+    fg[:, :, :3] = rng.integers(0, 256, 3)
+    fg[:, :, 0] = np.mgrid[0:800, 0:800][0] * 255 // 799
+    fg[100:550, 150:650, 3] = 255
+    paths = {"bg": os.path.join(_dirPath, "bg.jpg"), "dct": os.path.join(_dirPath, "dct.png"), "fg": os.path.join(_dirPath, "fg.png"), "sample": SAMPLE}
+    cv2.imwrite(paths["bg"], bg)
+    cv2.imwrite(paths["dct"], dct)
+    cv2.imwrite(paths["fg"], fg)
+    return paths
+
+def getFont(_ttfPath, _size):
+    """
+    Parameters
+    ----------
+    _ttfPath: string
+        Path of the ttfFile, or None for the default font of PIL
+    _size: int
+        Font size
+    Returns
+    ----------
+    ImageFont object
+        The font of the text stages
+    """
+    if _ttfPath is not None:
+        return ImageFont.truetype(_ttfPath, _size)
+    try:
+        return ImageFont.load_default(_size)
+    except TypeError:
+        return ImageFont.load_default()
+
+def getStageCalls(_factory, _paths, _bgPath, _font, _outDir):
+    """
+    Parameters
+    ----------
+    _factory: ImgFactory
+        Factory of the benchmarked resolution
+    _paths: dict
+        Paths of the inputs, see makeInputs
+    _bgPath: string
+        Path of the background of the run
+    _font: ImageFont
+        Font of the text stages
+    _outDir: string
+        Directory of the dumped images
+    Returns
+    ----------
+    Dict
+        A function without argument for each stage, and the number of pixels it processes
+    """
+    f = _factory
+    bg = f.readBg(_bgPath)
+    dct = f.readDct(_paths["dct"])
+    fg = f.readFg(_paths["fg"])
+    domain = f.getDomainColor(_bgPath)
+    target = f.getDomainColor(_paths["fg"])
+    bgPixels = bg.shape[0] * bg.shape[1]
+    dumpPath = os.path.join(_outDir, "dump.png")
+    return {
+        "readBg": (lambda: f.readBg(_bgPath), bgPixels),
+        "renderImg": (lambda: f.renderImg(bg, domain, target, 3), bgPixels),
+        "combineImg": (lambda: f.combineImg(bg, dct, fg, 0., -0.6), bgPixels),
+        "addText": (lambda: f.addText(bg, "Best Bag $300", _font, (0., 0.3, 0.), -0.2, -0.1), bgPixels),
+        "getTextImg": (lambda: f.getTextImg("Best Bag $300", _font, (0., 0.3, 0.)), bgPixels),
+        "getFocusedFg": (lambda: f.getFocusedFg(fg), fg.shape[0] * fg.shape[1]),
+        "dumpImg": (lambda: f.dumpImg(bg, dumpPath), bgPixels),
+    }
+
+def measure(_call, _pixels, _repeat, _warmup):
+    """
+    Parameters
+    ----------
+    _call: function
+        The stage to be measured
+    _pixels: int
+        Number of pixels processed by a call
+    _repeat: int
+        Number of timed calls
+    _warmup: int
+        Number of untimed calls before
+    Returns
+    ----------
+    Dict
+        Latency percentiles (ms), throughput and peak traced memory (bytes) of a call
+    """
+    for _ in range(_warmup):
+        _call()
+    latencies = []
+    for _ in range(_repeat):
+        start = time.perf_counter()
+        _call()
+        latencies.append(time.perf_counter() - start)
+    # peak memory is traced in a separate call, tracemalloc slows down the allocations
+    tracemalloc.start()
+    _call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies = np.array(latencies) * 1000
+    mean = float(np.mean(latencies))
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p90": float(np.percentile(latencies, 90)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": mean,
+        "callsPerSec": 1000 / mean if mean > 0 else float("inf"),
+        "mpixPerSec": _pixels / mean / 1000 if mean > 0 else float("inf"),
+        "peakBytes": peak,
+    }
+
+def checkGolden(_tolerance):
+    """
+    Parameters
+    ----------
+    _tolerance: int
+        Max tolerated difference of a pixel channel, from 0 to 255
+    Returns
+    ----------
+    Dict
+        Max difference against each committed TestData/SampleImage.styleNN.jpg, rendered and encoded like generate.py
+    """
+    h, w = cv2.imread(SAMPLE).shape[:2]
+    factory = ImgFactory((h, w), (h, w))
+    image = factory.readBg(SAMPLE)
+    styles = range(1, 14)
+    results = {}
+    for style, rendered in zip(styles, factory.renderImgs(image, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), styles)):
+        goldenPath = os.path.join(ROOT, "TestData", "SampleImage.style{:02d}.jpg".format(style))
+        actual = cv2.imdecode(np.frombuffer(factory.encodeImg(rendered, ".jpg"), dtype = np.uint8), cv2.IMREAD_COLOR)
+        golden = cv2.imread(goldenPath, cv2.IMREAD_COLOR)
+        diff = int(np.amax(np.abs(actual.astype(int) - golden.astype(int))))
+        results["style{:02d}".format(style)] = {"maxDiff": diff, "ok": diff <= _tolerance}
+    return results
+
+def checkReducedDecode(_dirPath):
+    """
+    Parameters
+    ----------
+    _dirPath: string
+        Directory of the EXIF-rotated input
+    Returns
+    ----------
+    Dict
+        Max difference of readBg with and without _reducedDecode on a JPEG with an EXIF orientation, which both decodes must ignore
+    """
+    rows, cols = np.mgrid[0:400, 0:1600]
+    image = PIL.Image.fromarray(np.dstack([cols * 255 // 1599, rows * 255 // 399, np.full([400, 1600], 80)]).astype(np.uint8))
+    exif = image.getexif()
+    # rotated 90 degrees clockwise by the viewers
+    exif[0x0112] = 6
+    path = os.path.join(_dirPath, "rotated.jpg")
+    image.save(path, exif = exif, quality = 95)
+    full = ImgFactory((50, 200), (50, 200), np.uint8).readBg(path)
+    reduced = ImgFactory((50, 200), (50, 200), np.uint8, _reducedDecode = True).readBg(path)
+    diff = int(np.amax(np.abs(full.astype(int) - reduced.astype(int))))
+    return {"maxDiff": diff, "ok": diff <= REDUCED_DECODE_TOLERANCE}
+
+def measureStartup(_repeat):
+    """
+    Parameters
+    ----------
+    _repeat: int
+        Number of fresh interpreters
+    Returns
+    ----------
+    Dict
+        Latency stats (see measure) of "import" (import imgfactory), "renderImg" (import and a first icon render) and "process" (the whole interpreter run)
+        peakBytes is the max RSS of the interpreter, and "modules" lists the heavy backends loaded by the first render
+    """
+    runs = []
+    modules = None
+    for _ in range(_repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd = ROOT, check = True, capture_output = True, text = True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        run["process"] = time.perf_counter() - start
+        modules = run.pop("modules")
+        runs.append(run)
+    results = {}
+    for key in ("import", "renderImg", "process"):
+        latencies = np.array([run[key] for run in runs]) * 1000
+        mean = float(np.mean(latencies))
+        results[key] = {
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "mean": mean,
+            "callsPerSec": 1000 / mean if mean > 0 else float("inf"),
+            "mpixPerSec": 0.,
+            "peakBytes": max(run["peakBytes"] for run in runs),
+        }
+    return results, modules
+
+def measureThreads(_factory, _bgPath, _threadCounts, _repeat, _warmup):
+    """
+    Parameters
+    ----------
+    _factory: ImgFactory
+        Factory shared by the threads
+    _bgPath: string
+        Path of the background rendered in all the 13 styles
+    _threadCounts: list of int
+        Sizes of the RenderPool to be measured, e.g. [1, 2, 4]
+    _repeat, _warmup:
+        See measure
+    Returns
+    ----------
+    Dict
+        Stats (see measure) of renderImgs over the 13 styles per pool size, with the "speedup" over the first size and the cv2 threads of the pool
+    """
+    bg = _factory.readBg(_bgPath)
+    domain = _factory.getDomainColor(_bgPath)
+    pixels = bg.shape[0] * bg.shape[1] * 13
+    results = {}
+    for threads in _threadCounts:
+        with RenderPool(threads) as pool:
+            stats = measure(lambda: list(_factory.renderImgs(bg, domain, (0.9, 0.1, 0.3), range(1, 14), _pool = pool)), pixels, _repeat, _warmup)
+            stats["cv2Threads"] = pool.cv2Threads
+        results[threads] = stats
+    base = results[_threadCounts[0]]["mean"]
+    for stats in results.values():
+        stats["speedup"] = base / stats["mean"]
+    return results
+
+def compareResults(_old, _new, _threshold):
+    """
+    Parameters
+    ----------
+    _old: dict
+        Results of the baseline run
+    _new: dict
+        Results of this run
+    _threshold: double
+        Tolerated relative slowdown of the p50 latency, e.g. 0.1 => 10%
+    Returns
+    ----------
+    List
+        Containing a line per stage, and whether any stage regressed
+    """
+    lines = []
+    regressed = False
+    for key, stats in sorted(_new["stages"].items()):
+        if key not in _old["stages"]:
+            continue
+        ratio = stats["p50"] / max(_old["stages"][key]["p50"], 1e-9)
+        memRatio = stats["peakBytes"] / max(_old["stages"][key]["peakBytes"], 1)
+        slow = ratio > 1 + _threshold
+        regressed = regressed or slow
+        lines.append("{} {:32s} p50 {:9.3f}ms -> {:9.3f}ms ({:5.2f}x)  peak {:6.2f}x".format("SLOWER" if slow else "      ", key, _old["stages"][key]["p50"], stats["p50"], ratio, memRatio))
+    return lines, regressed
+
+if __name__ == "__main__":
+
+    # read input from command line arg
+    parser = argparse.ArgumentParser(description = "ImgFactory Benchmark", formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--resolutions", nargs = "+", default = list(RESOLUTIONS), choices = list(RESOLUTIONS), help = "Resolutions to be benchmarked")
+    parser.add_argument("--stages", nargs = "+", default = list(STAGES), choices = list(STAGES), help = "Stages to be benchmarked")
+    parser.add_argument("--dtype", default = "float64", choices = ["float64", "float32", "uint8"], help = "Working dtype of the factory")
+    parser.add_argument("--reduced-decode", action = "store_true", help = "Let the readers decode large sources at reduced resolution, see ImgFactory")
+    parser.add_argument("--repeat", type = int, default = 10, help = "Number of timed calls per stage")
+    parser.add_argument("--warmup", type = int, default = 1, help = "Number of untimed calls per stage")
+    parser.add_argument("--seed", type = int, default = 3318, help = "Seed of the synthetic images")
+    parser.add_argument("--font", help = "TTF file of the text stages, the default font of PIL if not set")
+    parser.add_argument("--output", help = "Save the results as JSON")
+    parser.add_argument("--compare", help = "JSON results of a previous run to be diffed against")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "Tolerated relative p50 slowdown in --compare")
+    parser.add_argument("--golden", action = "store_true", help = "Check the rendered styles against TestData/*.styleNN.jpg, and the reduced decode against the full one")
+    parser.add_argument("--golden-tolerance", type = int, default = 0, help = "Max tolerated pixel difference of --golden, from 0 to 255")
+    parser.add_argument("--threads", type = int, nargs = "+", help = "Also measure renderImgs over the 13 styles with a RenderPool of each size, e.g. 1 2 4")
+    parser.add_argument("--startup", action = "store_true", help = "Also time the import and the first render in fresh interpreters")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "cv2": cv2.__version__, "machine": platform.machine(), "cpus": os.cpu_count(), "dtype": args.dtype, "reducedDecode": args.reduced_decode, "repeat": args.repeat, "seed": args.seed},
+        "stages": {},
+    }
+    failed = False
+    with tempfile.TemporaryDirectory() as tmpDir:
+        paths = makeInputs(tmpDir, args.seed)
+        for resolution in args.resolutions:
+            bgDim, fgDim = RESOLUTIONS[resolution]
+            font = getFont(args.font, max(8, bgDim[0] // 6))
+            for source in ("synthetic", "sample"):
+                factory = ImgFactory(bgDim, fgDim, getattr(np, args.dtype), _reducedDecode = args.reduced_decode)
+                calls = getStageCalls(factory, paths, paths["bg"] if source == "synthetic" else paths["sample"], font, tmpDir)
+                for stage in args.stages:
+                    call, pixels = calls[stage]
+                    key = "{}/{}/{}".format(resolution, source, stage)
+                    stats = measure(call, pixels, args.repeat, args.warmup)
+                    results["stages"][key] = stats
+                    print("{:32s} p50 {:9.3f}ms p90 {:9.3f}ms p99 {:9.3f}ms {:9.1f}/s {:8.1f}Mpx/s peak {:8.1f}MB".format(key, stats["p50"], stats["p90"], stats["p99"], stats["callsPerSec"], stats["mpixPerSec"], stats["peakBytes"] / 2 ** 20))
+                    sys.stdout.flush()
+                if args.threads:
+                    threaded = measureThreads(factory, paths["bg"] if source == "synthetic" else paths["sample"], args.threads, args.repeat, args.warmup)
+                    for threads, stats in threaded.items():
+                        key = "{}/{}/threads{}".format(resolution, source, threads)
+                        results["stages"][key] = stats
+                        print("{:32s} p50 {:9.3f}ms p90 {:9.3f}ms {:8.1f}Mpx/s speedup {:5.2f}x (cv2 threads {})".format(key, stats["p50"], stats["p90"], stats["mpixPerSec"], stats["speedup"], stats["cv2Threads"]))
+                    sys.stdout.flush()
+
+    if args.startup:
+        startup, modules = measureStartup(args.repeat)
+        for key, stats in startup.items():
+            results["stages"]["startup/" + key] = stats
+            print("{:32s} p50 {:9.3f}ms p90 {:9.3f}ms p99 {:9.3f}ms peak RSS {:8.1f}MB".format("startup/" + key, stats["p50"], stats["p90"], stats["p99"], stats["peakBytes"] / 2 ** 20))
+        print("startup backends loaded by the first render: {}".format(", ".join(modules) or "none"))
+
+    if args.golden:
+        results["golden"] = checkGolden(args.golden_tolerance)
+        for style, golden in results["golden"].items():
+            print("golden {} max diff {} {}".format(style, golden["maxDiff"], "ok" if golden["ok"] else "FAIL"))
+            failed = failed or not golden["ok"]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            results["reducedDecode"] = checkReducedDecode(tmpDir)
+        print("reduced decode of an EXIF-rotated jpg max diff {} {}".format(results["reducedDecode"]["maxDiff"], "ok" if results["reducedDecode"]["ok"] else "FAIL"))
+        failed = failed or not results["reducedDecode"]["ok"]
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as output:
+            json.dump(results, output, indent = 2)
+
+    if args.compare is not None:
+        with open(args.compare, encoding = "utf-8") as old:
+            lines, regressed = compareResults(json.load(old), results, args.threshold)
+        print("\n".join(lines))
+        failed = failed or regressed
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import glob
+import os
+import sys
+import time
+import numpy as np
+from colorthief import ColorThief, MMCQ
+from imgfactory import ImgFactory
+
+if __name__ == "__main__":
+
+    # read input from command line arg
+    parser = argparse.ArgumentParser(description = "Check ImgFactory.getDomainColor against ColorThief", formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("filepath", nargs = "*", default = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestData", "*.jpg"))), help = "Filepath of the Input Images")
+    parser.add_argument("--stride", type = int, nargs = "+", default = [1, 5], help = "Pixel sampling strides (ColorThief quality)")
+    parser.add_argument("--synthetic", type = int, default = 200, help = "Number of random few-color pixel sets whose quantization is compared exactly, full of ties between the boxes")
+    parser.add_argument("--seed", type = int, default = 3318, help = "Seed of the synthetic pixel sets")
+    args = parser.parse_args()
+
+    # compare both engines on every image and stride
+    factory = ImgFactory((1, 1), (1, 1))
+    failed = 0
+    for filepath in args.filepath:
+        for stride in args.stride:
+            start = time.perf_counter()
+            expected = ColorThief(filepath).get_color(quality = stride)
+            thiefTime = time.perf_counter() - start
+            start = time.perf_counter()
+            actual = factory.getDomainColor(filepath, stride)
+            factoryTime = time.perf_counter() - start
+            diff = max(abs(e / 255 - a) for e, a in zip(expected, actual))
+            ok = diff <= ImgFactory.DOMAIN_COLOR_TOLERANCE + 1e-9
+            failed += not ok
+            print("{} {} stride={} colorthief={} imgfactory={} diff={:.1f}/255 ({:.3f}s vs {:.3f}s)".format("ok  " if ok else "FAIL", os.path.basename(filepath), stride, expected, tuple(round(a * 255) for a in actual), diff * 255, thiefTime, factoryTime))
+
+    # the same MMCQ on decoded pixels, where any difference comes from the quantization (e.g. the order of equal boxes)
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    for _ in range(args.synthetic):
+        palette = rng.integers(0, 251, [int(rng.integers(2, 9)), 3])
+        rgb = np.repeat(palette, int(rng.integers(1, 4)), axis = 0) if rng.integers(0, 2) else palette[rng.integers(0, len(palette), int(rng.integers(5, 300)))]
+        expected = MMCQ.quantize([tuple(int(value) for value in pixel) for pixel in rgb], 5).palette[0]
+        bgra = np.concatenate([rgb[:, ::-1], np.full([len(rgb), 1], 255)], axis = 1).astype(np.uint8).reshape(-1, 1, 4)
+        actual = tuple(round(value * 255) for value in factory._getDomainColor(bgra, 1, True))
+        mismatches += actual != expected
+    print("{} synthetic pixel sets: {} mismatches".format(args.synthetic, mismatches))
+    failed += mismatches
+    sys.exit(1 if failed else 0)
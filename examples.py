@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 
+import os
 from imgfactory import ImgFactory
 
 # init
@@ -59,6 +60,9 @@ for idx, styleDict in enumerate(styleDicts):
 # dump to file
 factory.dumpImg(factory.resizeImg( testImg, (40, 95) ), "/web/public/images/tmp2.png")
 
+# all the CDN sizes from the single render, each resized from the nearest larger one
+factory.dumpPyramid(testImg, [(248, 682), (124, 341), (62, 170), (40, 95)], "/web/public/images/tmp2.{cols}x{rows}.png")
+
 # test only font
 factory = ImgFactory( (248, 682), (200, 200) )
 fg = factory.readFg("/data/prod_imgs_nb/1997134.png")
@@ -70,3 +74,42 @@ tmp = factory.getTextImg("Best Beg Forever", font, (0., 0.2, 0.8))
 img = factory.addTextImg(img, tmp, 0, 0.3)
 factory.dumpImg(img, "/web/public/images/font.png")
 
+
+# the same diff color demo as a layout template, where each bg/dct style is rendered once per product
+from layout import compileLayout
+layoutSpec = {
+    "bgDim": [248, 682], "fgDim": [200, 200],
+    "assets": {"bg": "/data/irene_bgs/b001.png", "bubble": "/data/irene_dcts/bubble-d-01.png"},
+    "fonts": {"pacifico": ["fonts/Pacifico.ttf", 50]},
+    "variants": [{
+        "output": "/web/public/images/{product}.colormap{variant}.png",
+        "layers": [
+            {"type": "bg", "asset": "bg", "style": styleDict["bg"]},
+            {"type": "dct", "asset": "bubble", "style": styleDict["dct"]},
+            {"type": "fg", "row": 0., "col": -0.6},
+            {"type": "text", "text": "Best Bag Forever", "font": "pacifico", "color": styleDict["text"], "row": -0.3, "col": -0.1}]
+    } for styleDict in styleDicts]}
+plan = compileLayout(layoutSpec)
+print( "\n".join(plan.describe()) )
+plan.run( factory.listDir("/data/prod_imgs_nb") )
+
+
+# a whole catalogue over the same bg and dct, 64 products per vectorized batch
+fgPaths = factory.listDir("/data/prod_imgs_nb")
+imgs = None
+for start in range(0, len(fgPaths), 64):
+    fgs = factory.getFocusedFgs( factory.readFgs(fgPaths[start:start + 64]) )
+    imgs = factory.combineImgs(bg, dct, fgs, 0., -0.6, imgs if imgs is not None and len(imgs) == len(fgs) else None)
+    for fgPath, img in zip(fgPaths[start:start + 64], imgs):
+        factory.dumpImg(img, "/web/public/images/" + os.path.basename(fgPath))
+
+
+# a hue-cycling promo animation of the bg, 4 frames per style streamed into the file
+factory.dumpHueCycle(bg, bgDomain, fgDomain, "/web/public/images/b001.cycle.gif", _frames = 56, _fps = 25)
+
+
+# index the products once, later campaigns read them (and their focus crop and domain color) from the index
+from fgindex import FgIndex, buildFgIndex
+buildFgIndex(factory, sorted(factory.listDir("/data/prod_imgs_nb")), "/data/prod_index")
+indexedFactory = ImgFactory( (248, 682), (200, 200), _fgIndex = FgIndex("/data/prod_index") )
+focusedFg = indexedFactory.readFocusedFg("/data/prod_imgs_nb/1997134.png")
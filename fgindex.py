@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+from imgfactory import ImgFactory
+
+# version of the index files, bump it whenever their layout changes
+INDEX_VERSION = 1
+
+class FgIndex:
+    """
+    Precomputed index of the products (foreground/item files) of a directory, built once by buildFgIndex
+    The directory holds fgs.npy (the decoded and resized 8-bit BGRA of each product), focused.npy (the 8-bit getFocusedFg of each product)
+    and meta.json (the row, mtime, size, focus crop box and domain color of each product, by path, the domain color is None if it has none)
+    The arrays are memory-mapped, so a lookup is a dict access and an os.stat, and the pages of the products never used are never read
+    Set it with ImgFactory(_fgIndex = ...) to serve readFg, readFgs, readFocusedFg and getDomainColor from it
+    """
+
+    def __init__(self, _dirPath):
+        """
+        Parameters
+        ----------
+        _dirPath: string
+            Directory of the index, see buildFgIndex
+        Returns
+        ----------
+        None
+        """
+        self.dirPath = _dirPath
+        with open(os.path.join(_dirPath, "meta.json"), encoding = "utf-8") as metaFile:
+            meta = json.load(metaFile)
+        if meta["version"] != INDEX_VERSION:
+            raise ValueError("index version {} is not {}, build the index again".format(meta["version"], INDEX_VERSION))
+        self.fgDim = tuple(meta["fgDim"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.stride = meta["stride"]
+        self.reducedDecode = meta["reducedDecode"]
+        self.pipelineVersion = meta["pipelineVersion"]
+        self.entries = meta["entries"]
+        self.hits = 0
+        self.misses = 0
+        self.fgs = np.load(os.path.join(_dirPath, "fgs.npy"), mmap_mode = "r")
+        self.focused = np.load(os.path.join(_dirPath, "focused.npy"), mmap_mode = "r")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check(self, _factory):
+        """
+        Parameters
+        ----------
+        _factory: ImgFactory
+            The factory to be served by the index
+        Returns
+        ----------
+        None
+            Raises ValueError if the index was built for another fgDim, working dtype, reducedDecode or pipeline version
+        """
+        if (self.fgDim, self.dtype, self.reducedDecode, self.pipelineVersion) != (tuple(_factory.fgDim), _factory.dtype, _factory.reducedDecode, _factory.PIPELINE_VERSION):
+            raise ValueError("index of fgDim {}, dtype {}, reducedDecode {} and pipeline {} does not match the factory".format(self.fgDim, self.dtype, self.reducedDecode, self.pipelineVersion))
+
+    def lookup(self, _fgPath):
+        """
+        Parameters
+        ----------
+        _fgPath: string
+            Path of a product
+        Returns
+        ----------
+        Dict
+            The entry of the product ("row", "mtime", "size", "box" and "domainRGB"), or None if it is not indexed or changed since
+        """
+        path = os.path.abspath(_fgPath)
+        entry = self.entries.get(path)
+        if entry is not None:
+            try:
+                stat = os.stat(path)
+                if entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                    entry = None
+            except OSError:
+                # deleted since the index was built
+                entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def getFg(self, _fgPath):
+        """
+        Returns
+        ----------
+        Numpy array
+            The (read-only) decoded and resized 8-bit BGRA of the product, with shape (fgDim[0], fgDim[1], 4), or None if not indexed
+        """
+        entry = self.lookup(_fgPath)
+        return None if entry is None else self.fgs[entry["row"]]
+
+    def getFocusedFg(self, _fgPath):
+        """
+        Returns
+        ----------
+        Numpy array
+            The (read-only) 8-bit focused product, with shape (fgDim[0], fgDim[1], 4), or None if not indexed
+        """
+        entry = self.lookup(_fgPath)
+        return None if entry is None else self.focused[entry["row"]]
+
+    def getDomainColor(self, _fgPath, _stride):
+        """
+        Returns
+        ----------
+        3-elemented tuple
+            The domain color of the product (see ImgFactory.getDomainColor), or None if not indexed with _stride or without a domain color
+        """
+        entry = self.lookup(_fgPath) if _stride == self.stride else None
+        return None if entry is None or entry["domainRGB"] is None else tuple(entry["domainRGB"])
+
+    def getStats(self):
+        """
+        Returns
+        ----------
+        Dict
+            Lookup hits and misses of this instance, and the number of indexed products
+        """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+def buildFgIndex(_factory, _fgPaths, _dirPath, _stride = 1):
+    """
+    Parameters
+    ----------
+    _factory: ImgFactory
+        Factory of the fgDim, working dtype and reducedDecode to be served, without fgIndex
+    _fgPaths: list of string
+        Paths of the products
+    _dirPath: string
+        Directory of the index, created if missing
+        The rows of an existing index of the same fgDim, dtype and stride are reused for the unchanged products
+    _stride: int
+        Stride of the indexed domain colors, see ImgFactory.getDomainColor
+    Returns
+    ----------
+    FgIndex
+        The index, written into _dirPath with the products in the order of _fgPaths
+        The arrays are filled through np.memmap one product at a time, the memory does not grow with the number of products
+    """
+    os.makedirs(_dirPath, exist_ok = True)
+    paths = list(dict.fromkeys(os.path.abspath(path) for path in _fgPaths))
+    previous = None
+    try:
+        previous = FgIndex(_dirPath)
+        previous.check(_factory)
+        if previous.stride != _stride:
+            previous = None
+    except (OSError, ValueError, KeyError):
+        previous = None
+    shape = (len(paths), _factory.fgDim[0], _factory.fgDim[1], 4)
+    tmpDir = os.path.join(_dirPath, "tmp.{}".format(uuid.uuid4().hex))
+    os.makedirs(tmpDir)
+    try:
+        fgs = np.lib.format.open_memmap(os.path.join(tmpDir, "fgs.npy"), mode = "w+", dtype = np.uint8, shape = shape)
+        focused = np.lib.format.open_memmap(os.path.join(tmpDir, "focused.npy"), mode = "w+", dtype = np.uint8, shape = shape)
+        entries = {}
+        for row, path in enumerate(paths):
+            entry = None if previous is None else previous.lookup(path)
+            if entry is not None:
+                fgs[row] = previous.fgs[entry["row"]]
+                focused[row] = previous.focused[entry["row"]]
+                entries[path] = dict(entry, row = row)
+                continue
+            stat = os.stat(path)
+            fg = _factory._readResized(path, _factory.fgDim)
+            fg = fg.reshape(fg.shape[0], fg.shape[1], -1)
+            if fg.shape[2] < 4:
+                # an opaque alpha is flattened into the same values as the expansion of _flattenAlpha, see ImgFactory.readFgs
+                fgs[row, :, :, :3] = fg[:, :, :3]
+                fgs[row, :, :, 3] = 255
+            else:
+                fgs[row] = fg
+            fgArr = _factory._flattenScaled(fgs[row], 1.05)
+            focused[row] = _factory._toUint8(_factory.getFocusedFg(fgArr))
+            try:
+                domainRGB = list(_factory.getDomainColor(path, _stride))
+            except ValueError:
+                # e.g. a white product on a transparent background, left to getDomainColor of the factory
+                domainRGB = None
+            entries[path] = {
+                "row": row,
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "box": list(_factory._getFocusBox(fgArr)),
+                "domainRGB": domainRGB,
+            }
+        fgs.flush()
+        focused.flush()
+        del fgs, focused
+        meta = {"version": INDEX_VERSION, "fgDim": list(_factory.fgDim), "dtype": _factory.dtype.name, "stride": _stride, "reducedDecode": _factory.reducedDecode, "pipelineVersion": _factory.PIPELINE_VERSION, "entries": entries}
+        with open(os.path.join(tmpDir, "meta.json"), "w", encoding = "utf-8") as metaFile:
+            json.dump(meta, metaFile, indent = 1, sort_keys = True)
+        # the previous arrays may still be mapped, replace the files instead of writing into them
+        previous = None
+        for fileName in ("fgs.npy", "focused.npy", "meta.json"):
+            os.replace(os.path.join(tmpDir, fileName), os.path.join(_dirPath, fileName))
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors = True)
+    return FgIndex(_dirPath)
+
+if __name__ == "__main__":
+
+    # read input from command line arg
+    parser = argparse.ArgumentParser(description = "Foreground Index Builder", formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("dirpath", help = "Directory of the products (foreground/item files)")
+    parser.add_argument("--index", required = True, help = "Directory of the index, rebuilt incrementally if it exists")
+    parser.add_argument("--pattern", default = r".*\.png", help = "Regex of the product file names")
+    parser.add_argument("--fg-dim", type = int, nargs = 2, default = [200, 200], help = "Foreground dimension (rows, cols) of the factory")
+    parser.add_argument("--dtype", default = "float64", choices = ["float64", "float32", "uint8"], help = "Working dtype of the factory")
+    parser.add_argument("--stride", type = int, default = 1, help = "Stride of the indexed domain colors")
+    args = parser.parse_args()
+
+    factory = ImgFactory(tuple(args.fg_dim), tuple(args.fg_dim), getattr(np, args.dtype))
+    index = buildFgIndex(factory, sorted(factory.listDir(args.dirpath, args.pattern)), args.index, args.stride)
+    print("{} products indexed into {}".format(len(index), args.index))
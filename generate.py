@@ -1,27 +1,352 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import glob
+import multiprocessing
 import os
-import PIL
-from imgfactory import ImgFactory
+import re
+import sys
+import tempfile
+import time
+import numpy as np
+import PIL.Image
+from imgfactory import ImgFactory, ImgWriter
+from rendercache import RenderCache
+
+STYLES = range(1, 14)
+
+# images picked up from a directory or a glob pattern, skipping the generated ".styleNN." outputs
+IMG_PATTERN = r"(?i)(?!.*\.style\d\d\.).*\.(png|jpe?g)$"
+
+def collectInputs(_filepaths, _manifest):
+    """
+    Parameters
+    ----------
+    _filepaths: list of string
+        Image paths, directories or glob patterns
+    _manifest: string
+        Path of a text file with one image path per line, or None
+    Returns
+    ----------
+    List
+        Containing the paths of the images, in the given order and without duplicates
+    """
+    factory = ImgFactory((1, 1), (1, 1))
+    entries = list(_filepaths)
+    if _manifest is not None:
+        with open(_manifest, encoding = "utf-8") as manifest:
+            entries += [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+    inputs = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            inputs += sorted(factory.listDir(entry, IMG_PATTERN))
+        elif glob.has_magic(entry):
+            inputs += sorted(path for path in glob.glob(entry) if re.match(IMG_PATTERN, os.path.basename(path)))
+        else:
+            inputs.append(entry)
+    return list(dict.fromkeys(inputs))
+
+def getOutputs(_filepath, _animate = None):
+    """
+    Parameters
+    ----------
+    _filepath: string
+        Path of the input image
+    _animate: string
+        Format of the hue-cycle animation, e.g. "gif", see generate
+    Returns
+    ----------
+    List
+        Containing the output paths, with extension ".styleNN.[jpg/png]", or the single ".cycle.<_animate>" animation
+    """
+    path, extension = os.path.splitext(_filepath)
+    if _animate is not None:
+        return ["{}.cycle.{}".format(path, _animate)]
+    return ["{}.style{:02d}{}".format(path, style, extension) for style in STYLES]
+
+def isUpToDate(_filepath, _animate = None):
+    """
+    Parameters
+    ----------
+    _filepath: string
+        Path of the input image
+    _animate: string
+        See getOutputs
+    Returns
+    ----------
+    bool
+        Whether every output exists and is newer than the input
+    """
+    mtime = os.path.getmtime(_filepath)
+    return all(os.path.exists(output) and os.path.getmtime(output) >= mtime for output in getOutputs(_filepath, _animate))
+
+def getCacheKeys(_cache, _filepath, _quality, _compression):
+    """
+    Parameters
+    ----------
+    _cache: RenderCache
+        The render cache
+    _filepath: string
+        Path of the input image
+    _quality, _compression:
+        See generate
+    Returns
+    ----------
+    Tuple
+        (hash of the input, a key per style)
+        The dimension is the input's own size and highS is off, both are covered by the input hash
+    """
+    inputHash = _cache.hashFile(_filepath)
+    ext = os.path.splitext(_filepath)[1].lower()
+    return inputHash, [_cache.getKey("generate", inputHash, style, False, ext, _quality, _compression) for style in STYLES]
+
+def generate(_filepath, _skipExisting = False, _quality = None, _compression = None, _tileRows = None, _mmapDir = None, _cacheDir = None, _cacheKeys = None, _animate = None, _frames = 56, _fps = 25):
+    """
+    Parameters
+    ----------
+    _filepath: string
+        Path of the input image
+    _skipExisting: bool
+        Skip the image if isUpToDate
+    _quality: int
+        JPEG/WebP quality from 0 to 100, the encoder default if None
+    _compression: int
+        PNG compression level from 0 to 9, the encoder default if None
+    _tileRows: int
+        Render in strips of _tileRows rows with bounded memory, see ImgFactory.renderFileTiled
+    _mmapDir: string
+        Directory of the memory-mapped output buffers of the tiled mode, rendering all the styles in one pass
+        If None, the styles are rendered one at a time through a single 8-bit buffer
+    _cacheDir: string
+        Directory of a RenderCache, the outputs of _cacheKeys found there are copied instead of rendered
+    _cacheKeys: list of string
+        Cache key of each style, see getCacheKeys
+    _animate: string
+        Write a hue-cycle animation ("gif", "webp", "mp4" or "avi") instead of the styles, see ImgFactory.dumpHueCycle
+        The frames are rendered from a single hsv conversion and encoded one at a time, not supported with _tileRows or _cacheDir
+    _frames: int
+        Number of frames of the animation, a full turn of the hue
+    _fps: double
+        Frames per second of the animation
+    Returns
+    ----------
+    Tuple
+        (output paths or None if skipped, dict of seconds spent in each stage and the number of cache hits)
+    """
+    timings = {"read": 0., "render": 0., "dump": 0., "cacheHits": 0}
+    if _skipExisting and isUpToDate(_filepath, _animate):
+        return None, timings
+    outputs = getOutputs(_filepath, _animate)
+    styles = list(STYLES)
+
+    # copy the cached styles
+    if _cacheDir is not None:
+        cache = RenderCache(_cacheDir)
+        start = time.perf_counter()
+        hits = [cache.getFile(key, output) for key, output in zip(_cacheKeys, outputs)]
+        timings["dump"] += time.perf_counter() - start
+        timings["cacheHits"] = sum(hits)
+        styles = [style for style, hit in zip(STYLES, hits) if not hit]
+        if not styles:
+            return outputs, timings
+
+    # read image and create factory
+    start = time.perf_counter()
+    w, h = PIL.Image.open(_filepath).size
+    factory = ImgFactory((h, w), (h, w))
+    if _tileRows is not None:
+        generateTiled(factory, _filepath, styles, _quality, _compression, _tileRows, _mmapDir, timings)
+    else:
+        # the outputs have the format of the input, only PNG/WebP keep the (opaque) alpha
+        image = factory.readBg(_filepath, os.path.splitext(_filepath)[1].lower() not in (".jpg", ".jpeg"))
+        timings["read"] += time.perf_counter() - start
+        if _animate is not None:
+            # rendering and encoding are interleaved frame by frame, both counted as render
+            start = time.perf_counter()
+            factory.dumpHueCycle(image, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), outputs[0], _frames, _fps, _quality = _quality)
+            timings["render"] += time.perf_counter() - start
+            return outputs, timings
+        renderStyles(factory, image, outputs, styles, _quality, _compression, timings)
+
+    # keep the rendered styles in the cache
+    if _cacheDir is not None:
+        start = time.perf_counter()
+        for style, key, output in zip(STYLES, _cacheKeys, outputs):
+            if style in styles:
+                cache.putFile(key, output)
+        timings["dump"] += time.perf_counter() - start
+    return outputs, timings
+
+def renderStyles(_factory, _image, _outputs, _styles, _quality, _compression, _timings):
+    """
+    Parameters
+    ----------
+    _factory: ImgFactory
+        Factory of the image size
+    _image: numpy array
+        The image read by readBg
+    _outputs: list of string
+        Output path of every style of STYLES
+    _styles: list of int
+        The styles to be rendered
+    _quality, _compression:
+        See generate
+    _timings: dict
+        Seconds spent in each stage, updated in place
+    Returns
+    ----------
+    None
+    """
+    # dump different color style, encoding in the background while the next style is rendered
+    outputs = [output for style, output in zip(STYLES, _outputs) if style in _styles]
+    rendered = _factory.renderImgs(_image, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), _styles)
+    with ImgWriter(_factory, _maxPending = 4, _quality = _quality, _compression = _compression) as writer:
+        for output in outputs:
+            start = time.perf_counter()
+            img = next(rendered)
+            _timings["render"] += time.perf_counter() - start
+            start = time.perf_counter()
+            writer.submit(img, output)
+            _timings["dump"] += time.perf_counter() - start
+        start = time.perf_counter()
+    _timings["dump"] += time.perf_counter() - start
+
+def generateTiled(_factory, _filepath, _styles, _quality, _compression, _tileRows, _mmapDir, _timings):
+    """
+    Parameters
+    ----------
+    _factory: ImgFactory
+        Factory of the image size
+    _filepath, _quality, _compression, _tileRows, _mmapDir:
+        See generate
+    _styles: list of int
+        The styles to be rendered
+    _timings: dict
+        Seconds spent in each stage, updated in place
+    Returns
+    ----------
+    None
+    """
+    outputs = [output for style, output in zip(STYLES, getOutputs(_filepath)) if style in _styles]
+    shape = (_factory.bgDim[0], _factory.bgDim[1], 4)
+    if _mmapDir is None:
+        # one style at a time through a single 8-bit buffer
+        out = np.empty(shape, dtype = np.uint8)
+        for style, output in zip(_styles, outputs):
+            start = time.perf_counter()
+            _factory.renderFileTiled(_filepath, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), [style], [out], _tileRows = _tileRows)
+            _timings["render"] += time.perf_counter() - start
+            start = time.perf_counter()
+            _factory.dumpImg(out, output, _quality, _compression)
+            _timings["dump"] += time.perf_counter() - start
+        return
+    # all the styles in a single pass, through memory-mapped buffers that the OS can page out
+    with tempfile.TemporaryDirectory(dir = _mmapDir) as tmpDir:
+        outs = [np.lib.format.open_memmap(os.path.join(tmpDir, "style{:02d}.npy".format(style)), mode = "w+", dtype = np.uint8, shape = shape) for style in _styles]
+        start = time.perf_counter()
+        _factory.renderFileTiled(_filepath, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), _styles, outs, _tileRows = _tileRows)
+        _timings["render"] += time.perf_counter() - start
+        for out, output in zip(outs, outputs):
+            start = time.perf_counter()
+            _factory.dumpImg(out, output, _quality, _compression)
+            _timings["dump"] += time.perf_counter() - start
+        del outs
+
+def _generateTask(_task):
+    # an input that fails is reported by the main loop, instead of aborting the batch (and the pool)
+    try:
+        return generate(*_task) + (None,)
+    except Exception as error:
+        return None, None, "{}: {}".format(type(error).__name__, error)
 
 if __name__ == "__main__":
 
     # read input from command line arg
     parser = argparse.ArgumentParser(description = "Colorful Image Generation Script", formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("filepath", help = "Filepath of the Input Image")
+    parser.add_argument("filepath", nargs = "*", help = "Filepath of the Input Image, a directory or a glob pattern")
+    parser.add_argument("--manifest", help = "Text file listing one input image per line")
+    parser.add_argument("--workers", type = int, default = 1, help = "Number of worker processes")
+    parser.add_argument("--chunksize", type = int, default = 4, help = "Number of images sent to a worker at a time")
+    parser.add_argument("--skip-existing", action = "store_true", help = "Skip the images whose outputs are newer than the input")
+    parser.add_argument("--quality", type = int, help = "JPEG/WebP quality from 0 to 100, the encoder default if not set")
+    parser.add_argument("--compression", type = int, help = "PNG compression level from 0 to 9, the encoder default if not set")
+    parser.add_argument("--tile-rows", type = int, help = "Render in strips of this many rows and one style at a time, with memory bounded by the strip and an 8-bit buffer")
+    parser.add_argument("--mmap-dir", help = "With --tile-rows, render all the styles in a single pass into memory-mapped buffers under this directory")
+    parser.add_argument("--cache", help = "Directory of a content-hash render cache, only the inputs whose hash changed are rendered again")
+    parser.add_argument("--cache-mb", type = int, default = 1024, help = "Size cap of --cache, the least recently used outputs are evicted")
+    parser.add_argument("--animate", choices = ["gif", "webp", "mp4", "avi"], help = "Write a hue-cycle animation <name>.cycle.<format> instead of the 13 styles, --quality only applies to webp")
+    parser.add_argument("--frames", type = int, default = 56, help = "Number of frames of --animate, a full turn of the hue")
+    parser.add_argument("--fps", type = float, default = 25, help = "Frames per second of --animate")
+    parser.add_argument("--summary", action = "store_true", help = "Print the throughput summary at the end")
     args = parser.parse_args()
+    inputs = collectInputs(args.filepath, args.manifest)
+    if not inputs:
+        parser.error("no input image")
+    if args.mmap_dir is not None and args.tile_rows is None:
+        parser.error("--mmap-dir requires --tile-rows")
+    if args.animate is not None and (args.tile_rows is not None or args.cache is not None or args.compression is not None):
+        parser.error("--animate does not support --tile-rows, --cache or --compression")
+    if args.frames < 1:
+        parser.error("--frames must be positive")
+    if not args.fps > 0:
+        parser.error("--fps must be positive")
 
-    # read image and create factory
-    w, h = PIL.Image.open(args.filepath).size
-    factory = ImgFactory((h, w), (h, w))
-    image = factory.readBg(args.filepath)
+    # render every image, in a process pool if there are multiple workers
+    start = time.perf_counter()
+    done, skipped, failed, cacheHits = 0, 0, 0, 0
+    cache = None if args.cache is None else RenderCache(args.cache, args.cache_mb * 1024 * 1024)
+    inputHashes, cacheKeys = {}, {}
+    if cache is not None:
+        # the outputs recorded in the manifest with the same keys are up to date, without reading the unchanged inputs
+        remaining = []
+        for filepath in inputs:
+            try:
+                inputHashes[filepath], cacheKeys[filepath] = getCacheKeys(cache, filepath, args.quality, args.compression)
+            except OSError as error:
+                print("failed {}: {}: {}".format(filepath, type(error).__name__, error), file = sys.stderr)
+                failed += 1
+                continue
+            if all(cache.isFresh(output, key) for output, key in zip(getOutputs(filepath), cacheKeys[filepath])):
+                skipped += 1
+            else:
+                remaining.append(filepath)
+        inputs = remaining
+    tasks = [(filepath, args.skip_existing, args.quality, args.compression, args.tile_rows, args.mmap_dir, args.cache, cacheKeys.get(filepath), args.animate, args.frames, args.fps) for filepath in inputs]
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    totals = {"read": 0., "render": 0., "dump": 0.}
+    try:
+        results = map(_generateTask, tasks) if pool is None else pool.imap(_generateTask, tasks, chunksize = args.chunksize)
+        for filepath, (outputs, timings, error) in zip(inputs, results):
+            if error is not None:
+                print("failed {}: {}".format(filepath, error), file = sys.stderr)
+                failed += 1
+                continue
+            if outputs is None:
+                skipped += 1
+                continue
+            done += 1
+            cacheHits += timings["cacheHits"]
+            for stage in totals:
+                totals[stage] += timings[stage]
+            for output, key in zip(outputs, cacheKeys.get(filepath, [])):
+                cache.record(output, key, {filepath: inputHashes[filepath]})
+            for output in outputs:
+                print(output)
+    finally:
+        # the images done so far are kept in the manifest, even if the batch is interrupted
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.save()
+    elapsed = time.perf_counter() - start
 
-    # dump different color style
-    path, extension = os.path.splitext(args.filepath)
-    for style in range(1, 14):
-        rendered = factory.renderImg(image, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), style)
-        output = "{}.style{:02d}{}".format(path, style, extension)
-        factory.dumpImg(rendered, output)
-        print(output)
+    # throughput summary
+    if args.summary or done + skipped + failed > 1:
+        print("{} rendered, {} skipped, {} failed in {:.2f}s ({:.2f} images/s, {} workers)".format(done, skipped, failed, elapsed, done / elapsed, args.workers))
+        if cache is not None:
+            print("  {} styles copied from the cache".format(cacheHits))
+        for stage, seconds in totals.items():
+            print("  {:<6s} {:8.2f}s total {:8.1f}ms/image".format(stage, seconds, 1000 * seconds / max(done, 1)))
 
+    sys.exit(1 if failed else 0)
@@ -2,19 +2,716 @@
 
 import os
 import re
+import collections
+import functools
+import hashlib
+import importlib
+import threading
+import time
+import json
+import types
+import tracemalloc
+import contextlib
 import colorsys
+import io
+import struct
 import numpy as np
-import cv2
-from colorthief import ColorThief
-import PIL
-from PIL import ImageFont
-from PIL import Image
-from PIL import ImageDraw
-import matplotlib
+
+class _LazyModule:
+    """
+    Module imported at its first attribute access, so that importing imgfactory only pays for numpy
+    The attributes are cached on the proxy, later accesses are plain attribute lookups
+    """
+
+    def __init__(self, _name):
+        self._name = _name
+
+    def __getattr__(self, _attr):
+        value = getattr(importlib.import_module(self._name), _attr)
+        setattr(self, _attr, value)
+        return value
+
+cv2 = _LazyModule("cv2")
+Image = _LazyModule("PIL.Image")
+ImageFont = _LazyModule("PIL.ImageFont")
+ImageDraw = _LazyModule("PIL.ImageDraw")
+futures = _LazyModule("concurrent.futures")
+
+class AssetCache:
+    """
+    Bounded LRU cache of the decoded and resized assets returned by the ImgFactory readers
+    The entries are keyed on (read mode, absolute path, mtime, dimension, dtype, reduced decode) and evicted by bytes
+    The cached arrays are shared and read-only, copy them before any in-place modification
+    Safe to share between threads, two threads missing the same key may both run the loader
+    """
+
+    def __init__(self, _maxBytes = 256 * 1024 * 1024, _diskDir = None):
+        """
+        Parameters
+        ----------
+        _maxBytes: int
+            Max total bytes of the arrays kept in memory
+        _diskDir: string
+            Optional directory of the on-disk tier, where the arrays are saved as .npy and loaded via mmap
+            The file names also hash ImgFactory.PIPELINE_VERSION, so bumping it invalidates the arrays of older readers
+            Worker processes sharing the directory skip decoding the same asset again
+        Returns
+        ----------
+        None
+        """
+        self.maxBytes = _maxBytes
+        self.diskDir = _diskDir
+        self.nbytes = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if _diskDir is not None:
+            os.makedirs(_diskDir, exist_ok = True)
+
+    def get(self, _mode, _path, _params, _loader):
+        """
+        Parameters
+        ----------
+        _mode: string
+            Read mode, e.g. "bg" or "dct"
+        _path: string
+            Path of the asset file
+        _params: tuple
+            Everything else the result depends on, e.g. target dimension and dtype
+        _loader: function
+            Called without argument to read the asset on a miss
+        Returns
+        ----------
+        Numpy array
+            The cached (read-only) array
+        """
+        path = os.path.abspath(_path)
+        key = (_mode, path, os.stat(path).st_mtime_ns, _params)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        diskPath = None
+        if self.diskDir is not None:
+            # the on-disk arrays outlive the process, so their names also cover the version of the readers
+            diskKey = (ImgFactory.PIPELINE_VERSION,) + key
+            diskPath = os.path.join(self.diskDir, hashlib.sha1(repr(diskKey).encode("utf-8")).hexdigest() + ".npy")
+        if diskPath is not None and os.path.exists(diskPath):
+            arr = np.load(diskPath, mmap_mode = "r")
+            with self._lock:
+                self.diskHits += 1
+        else:
+            arr = _loader()
+            with self._lock:
+                self.misses += 1
+            if diskPath is not None:
+                tmpPath = "{}.{}.{}.tmp.npy".format(diskPath[:-4], os.getpid(), threading.get_ident())
+                np.save(tmpPath, arr)
+                os.replace(tmpPath, diskPath)
+        arr.setflags(write = False)
+        with self._lock:
+            if key not in self._entries:
+                self.nbytes += arr.nbytes
+            self._entries[key] = arr
+            while self.nbytes > self.maxBytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last = False)
+                self.nbytes -= evicted.nbytes
+        return arr
+
+    def getStats(self):
+        """
+        Returns
+        ----------
+        Dict
+            Hit/miss counters, number of entries and bytes kept in memory
+        """
+        return {"hits": self.hits, "diskHits": self.diskHits, "misses": self.misses, "entries": len(self._entries), "nbytes": self.nbytes}
+
+    def clear(self):
+        """
+        Drop the in-memory entries, the on-disk tier is kept
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+def _cachedAsset(_mode):
+    """
+    Decorator of the ImgFactory readers, serving them from ImgFactory.assetCache if set
+    """
+    def decorator(_reader):
+        @functools.wraps(_reader)
+        def wrapper(self, _path, *args, **kwargs):
+            if self.assetCache is None:
+                return _reader(self, _path, *args, **kwargs)
+            params = (self.bgDim, self.fgDim, args, tuple(sorted(kwargs.items())), self.dtype.str, self.reducedDecode)
+            return self.assetCache.get(_mode, _path, params, lambda: _reader(self, _path, *args, **kwargs))
+        return wrapper
+    return decorator
+
+class Profiler:
+    """
+    Per-method instrumentation of ImgFactory, recording wall time, shapes and bytes of every public method call
+    Set it with ImgFactory(_profiler = ...) or ImgFactory.profile(), a factory without profiler only pays an attribute check per call
+    Nested public calls (e.g. renderImg calling renderImgs) are recorded for both methods
+    The traced peaks are process-wide (tracemalloc): the peak of a call includes the memory already allocated before it, e.g. by an outer call
+    Concurrent calls would mix their peaks, so the memory is not traced while a RenderPool is open
+    """
+
+    def __init__(self, _traceMemory = False, _callback = None):
+        """
+        Parameters
+        ----------
+        _traceMemory: bool
+            Also record the process-wide peak of the traced bytes during each call via tracemalloc, which slows down the allocations
+            The calls made while a RenderPool is open record the bytes of their results instead
+        _callback: function
+            Optional, called with (method name, seconds, input shapes, output shape, bytes) after every call
+        Returns
+        ----------
+        None
+        """
+        self.traceMemory = _traceMemory
+        self.callback = _callback
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def call(self, _name, _method, _args, _kwargs):
+        """
+        Parameters
+        ----------
+        _name: string
+            Method name
+        _method: function
+            The bound method to be called
+        _args, _kwargs:
+            Arguments of the call
+        Returns
+        ----------
+        Any
+            The result of the call, generators are wrapped so that every item is recorded as a call
+        """
+        inShapes = tuple(arg.shape for arg in _args if isinstance(arg, np.ndarray))
+        traceMemory = self.traceMemory and not RenderPool._openPools
+        tracing = traceMemory and not tracemalloc.is_tracing()
+        peaks = None
+        if tracing:
+            tracemalloc.start()
+        if traceMemory:
+            # a nested call resets the peak, so the peak of the outer calls so far is kept on a per-thread stack
+            peaks = self._local.__dict__.setdefault("peaks", [])
+            if peaks:
+                peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+            peaks.append(0)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        allocated = None
+        try:
+            result = _method(*_args, **_kwargs)
+            seconds = time.perf_counter() - start
+        finally:
+            if peaks is not None:
+                allocated = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if peaks:
+                    peaks[-1] = max(peaks[-1], allocated)
+            if tracing:
+                tracemalloc.stop()
+        if isinstance(result, types.GeneratorType):
+            return self._wrapGenerator(_name, result, inShapes)
+        self.record(_name, seconds, inShapes, getattr(result, "shape", None), self._getBytes(result, allocated))
+        return result
+
+    def record(self, _name, _seconds, _inShapes, _outShape, _bytes):
+        """
+        Parameters
+        ----------
+        _name: string
+            Method name
+        _seconds: double
+            Wall time of the call
+        _inShapes: tuple
+            Shapes of the array arguments
+        _outShape: tuple
+            Shape of the returned array, or None
+        _bytes: int
+            Bytes allocated by the call (traced) or returned, see getSummary
+        Returns
+        ----------
+        None
+        """
+        with self._lock:
+            stats = self._stats.setdefault(_name, {"calls": 0, "seconds": 0., "maxSeconds": 0., "bytes": 0, "inShapes": None, "outShape": None})
+            stats["calls"] += 1
+            stats["seconds"] += _seconds
+            stats["maxSeconds"] = max(stats["maxSeconds"], _seconds)
+            stats["bytes"] += _bytes
+            stats["inShapes"] = _inShapes
+            stats["outShape"] = _outShape
+        if self.callback is not None:
+            self.callback(_name, _seconds, _inShapes, _outShape, _bytes)
+
+    def getSummary(self):
+        """
+        Returns
+        ----------
+        Dict
+            For each method, the number of calls, total and max seconds, total bytes and the shapes of the last call
+            The bytes are the process-wide traced peaks with _traceMemory (outside of a RenderPool), otherwise the bytes of the returned arrays
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def toJSON(self):
+        """
+        Returns
+        ----------
+        string
+            The summary in JSON
+        """
+        return json.dumps(self.getSummary(), indent = 2, sort_keys = True)
+
+    def toPrometheus(self, _prefix = "imgfactory"):
+        """
+        Parameters
+        ----------
+        _prefix: string
+            Prefix of the metric names
+        Returns
+        ----------
+        string
+            The counters in the Prometheus text exposition format
+        """
+        summary = self.getSummary()
+        lines = []
+        for metric, key, metricType, help in (
+            ("calls_total", "calls", "counter", "Number of ImgFactory method calls"),
+            ("seconds_total", "seconds", "counter", "Wall time spent in ImgFactory methods"),
+            ("seconds_max", "maxSeconds", "gauge", "Max wall time of a single ImgFactory method call"),
+            ("bytes_total", "bytes", "counter", "Bytes allocated or returned by ImgFactory methods")):
+            lines.append("# HELP {}_{} {}".format(_prefix, metric, help))
+            lines.append("# TYPE {}_{} {}".format(_prefix, metric, metricType))
+            for name in sorted(summary):
+                lines.append('{}_{}{{method="{}"}} {}'.format(_prefix, metric, name, summary[name][key]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Drop all the recorded counters
+        """
+        with self._lock:
+            self._stats.clear()
+
+    def _getBytes(self, _result, _allocated):
+        if _allocated is not None:
+            return _allocated
+        if isinstance(_result, tuple):
+            return sum(item.nbytes for item in _result if isinstance(item, np.ndarray))
+        return getattr(_result, "nbytes", 0)
+
+    def _wrapGenerator(self, _name, _generator, _inShapes):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(_generator)
+            except StopIteration:
+                return
+            self.record(_name, time.perf_counter() - start, _inShapes, getattr(item, "shape", None), getattr(item, "nbytes", 0))
+            yield item
+
+def _profiled(_method):
+    """
+    Decorator of the public ImgFactory methods, recording the calls in ImgFactory.profiler if set
+    """
+    name = _method.__name__
+    @functools.wraps(_method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return _method(self, *args, **kwargs)
+        return self.profiler.call(name, _method, (self,) + args, kwargs)
+    return wrapper
+
+class ImgWriter:
+    """
+    Output stage encoding and writing images on a background thread pool
+    Rendering of the next image overlaps with the encoding (cv2 releases the GIL) and the disk I/O of the previous ones
+    """
+
+    def __init__(self, _factory, _workers = 2, _maxPending = 8, _quality = None, _compression = None, _bulk = False):
+        """
+        Parameters
+        ----------
+        _factory: ImgFactory
+            The factory of the working dtype of the images
+        _workers: int
+            Number of encoding threads
+        _maxPending: int
+            Max number of images queued or being encoded, submit blocks when it is reached
+        _quality: int
+            JPEG/WebP quality from 0 to 100, the encoder default if None
+        _compression: int
+            PNG compression level from 0 to 9, the encoder default if None
+        _bulk: bool
+            Keep the encoded bytes in memory and write all the files at flush, e.g. at the end of a batch
+        Returns
+        ----------
+        None
+        """
+        self.factory = _factory
+        self.quality = _quality
+        self.compression = _compression
+        self.bulk = _bulk
+        self._executor = futures.ThreadPoolExecutor(_workers)
+        self._slots = threading.BoundedSemaphore(_maxPending)
+        self._futures = []
+        self._encoded = []
+        self._lock = threading.Lock()
+
+    def submit(self, _imgArr, _outputPath):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            Pixel values of the image, from 0.0 to 1.0
+        _outputPath: string
+            Prefered path of the ouptut file
+        Returns
+        ----------
+        Future
+            Resolved with _outputPath once the file is written (or encoded, in bulk mode)
+        """
+        ext = os.path.splitext(_outputPath)[1]
+        return self._submit(_imgArr, ext, _outputPath)
+
+    def encode(self, _imgArr, _ext):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            Pixel values of the image, from 0.0 to 1.0
+        _ext: string
+            Extension of the format, e.g. ".png", ".jpg" or ".webp"
+        Returns
+        ----------
+        Future
+            Resolved with the encoded bytes
+        """
+        return self._submit(_imgArr, _ext, None)
+
+    def flush(self):
+        """
+        Wait for all the submitted images, and write the files kept in bulk mode
+        Raises the first error of the submitted images
+        """
+        with self._lock:
+            pending, self._futures = self._futures, []
+        futures.wait(pending)
+        with self._lock:
+            encoded, self._encoded = self._encoded, []
+        for outputPath, data in encoded:
+            with open(outputPath, "wb") as output:
+                output.write(data)
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """
+        Flush and stop the encoding threads
+        """
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _excType, _excValue, _traceback):
+        self.close()
+
+    def _submit(self, _imgArr, _ext, _outputPath):
+        # convert (and copy) on the caller thread so that _imgArr can be reused right away
+        img = self.factory._toImage(_imgArr)
+        if np.shares_memory(img, _imgArr):
+            img = np.copy(img)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._encode, img, _ext, _outputPath)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            # drop the finished futures, keeping the failed ones for flush
+            self._futures = [f for f in self._futures if not f.done() or f.exception() is not None]
+            self._futures.append(future)
+        return future
+
+    def _encode(self, _img, _ext, _outputPath):
+        try:
+            data = self.factory.encodeImg(_img, _ext, self.quality, self.compression)
+            if _outputPath is None:
+                return data
+            if self.bulk:
+                with self._lock:
+                    self._encoded.append( (_outputPath, data) )
+            else:
+                with open(_outputPath, "wb") as output:
+                    output.write(data)
+            return _outputPath
+        finally:
+            self._slots.release()
+
+class RenderPool:
+    """
+    Thread pool running the ImgFactory methods in parallel, e.g. renderImgs(..., _pool = pool) or pool.map over a batch
+    The heavy numpy and cv2 loops release the GIL, and each thread renders into its own scratch buffers (freed when the pool is closed)
+    While the pool is open cv2 runs cpu_count // workers threads per call (process-wide), so that the two levels do not oversubscribe the cores
+    Pools can overlap or nest: cv2 runs the fewest threads of the open pools, and the value from before the first one is restored when the last one closes
+    """
+
+    # the open pools, and the cv2 threads from before the first of them, guarded by _cv2Lock
+    _openPools = []
+    _cv2ThreadsBefore = None
+    _cv2Lock = threading.Lock()
+
+    def __init__(self, _workers = None, _cv2Threads = None):
+        """
+        Parameters
+        ----------
+        _workers: int
+            Number of rendering threads, os.cpu_count() if None
+        _cv2Threads: int
+            Threads of each cv2 call while the pool is open, max(1, os.cpu_count() // _workers) if None
+        Returns
+        ----------
+        None
+        """
+        cpus = os.cpu_count() or 1
+        self.workers = _workers or cpus
+        self.cv2Threads = _cv2Threads or max(1, cpus // self.workers)
+        with RenderPool._cv2Lock:
+            if not RenderPool._openPools:
+                RenderPool._cv2ThreadsBefore = cv2.getNumThreads()
+            RenderPool._openPools.append(self)
+            cv2.setNumThreads(min(pool.cv2Threads for pool in RenderPool._openPools))
+        self._executor = futures.ThreadPoolExecutor(self.workers)
+
+    def submit(self, _function, *args, **kwargs):
+        """
+        Returns
+        ----------
+        Future
+            Resolved with _function(*args, **kwargs), called on a pool thread
+        """
+        return self._executor.submit(_function, *args, **kwargs)
+
+    def map(self, _function, *iterables):
+        """
+        Returns
+        ----------
+        Iterator
+            The results of _function over the zipped iterables, in order
+        """
+        return self._executor.map(_function, *iterables)
+
+    def close(self):
+        """
+        Wait for the submitted calls, stop the threads and release the cv2 threads of the pool
+        """
+        try:
+            self._executor.shutdown()
+        finally:
+            with RenderPool._cv2Lock:
+                if self in RenderPool._openPools:
+                    RenderPool._openPools.remove(self)
+                    if RenderPool._openPools:
+                        cv2.setNumThreads(min(pool.cv2Threads for pool in RenderPool._openPools))
+                    else:
+                        cv2.setNumThreads(RenderPool._cv2ThreadsBefore)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _excType, _excValue, _traceback):
+        self.close()
+
+class AnimationWriter:
+    """
+    Animated GIF/WebP or MP4 written one frame at a time, e.g. the frames of ImgFactory.renderHueCycle
+    Each frame is encoded and appended to the file as soon as it is added, so the memory does not grow with the number of frames
+    GIF and WebP frames go through the still encoders (PIL and cv2) and their bitstreams are wrapped into the animation container, MP4 goes through cv2.VideoWriter
+    """
+
+    # fourcc of cv2.VideoWriter per video extension
+    FOURCCS = {".mp4": "mp4v", ".avi": "MJPG"}
+
+    def __init__(self, _factory, _outputPath, _fps = 25, _loop = 0, _quality = None):
+        """
+        Parameters
+        ----------
+        _factory: ImgFactory
+            The factory of the working dtype of the frames
+        _outputPath: string
+            Path of the ouptut file, the format is picked by the extension: ".gif", ".webp", ".mp4" or ".avi"
+        _fps: double
+            Frames per second
+        _loop: int
+            Number of loops of the GIF/WebP animation, 0 => forever
+        _quality: int
+            WebP quality from 0 to 100, the encoder default if None
+        Returns
+        ----------
+        None
+        """
+        self.factory = _factory
+        self.outputPath = _outputPath
+        self.fps = _fps
+        self.loop = _loop
+        self.quality = _quality
+        self.frames = 0
+        self.ext = os.path.splitext(_outputPath)[1].lower()
+        if self.ext not in (".gif", ".webp") and self.ext not in self.FOURCCS:
+            raise ValueError("unsupported animation format: {}".format(self.ext))
+        if not _fps > 0:
+            raise ValueError("fps must be positive: {}".format(_fps))
+        self._file = None
+        self._video = None
+
+    def add(self, _imgArr):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            Pixel values of the next frame, from 0.0 to 1.0, with the same shape as the first one
+        Returns
+        ----------
+        None
+        """
+        img = self.factory._toImage(_imgArr)
+        if self.frames == 0:
+            self._open(img)
+        elif img.shape != self._shape:
+            raise ValueError("frame shape {} differs from the first frame {}".format(img.shape, self._shape))
+        # per-frame durations from the rounded timestamps, so that they do not drift from _fps
+        unit = 100 if self.ext == ".gif" else 1000
+        duration = round(unit * (self.frames + 1) / self.fps) - round(unit * self.frames / self.fps)
+        if self.ext == ".gif":
+            self._addGif(img, duration)
+        elif self.ext == ".webp":
+            self._addWebp(img, duration)
+        else:
+            self._video.write(img if img.shape[2] == 3 else self.factory._toImage(self.factory.bgra2Bgr(self.factory._fromUint8(img))))
+        self.frames += 1
+
+    def close(self):
+        """
+        Finish the container and close the file
+        """
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+        if self._file is not None:
+            if self.ext == ".gif":
+                self._file.write(b";")
+            else:
+                # size of the RIFF container, unknown until the last frame
+                size = self._file.tell()
+                self._file.seek(4)
+                self._file.write(struct.pack("<I", size - 8))
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _excType, _excValue, _traceback):
+        self.close()
+
+    def _open(self, _img):
+        self._shape = _img.shape
+        rows, cols = _img.shape[:2]
+        if self.ext in self.FOURCCS:
+            self._video = cv2.VideoWriter(self.outputPath, cv2.VideoWriter_fourcc(*self.FOURCCS[self.ext]), self.fps, (cols, rows))
+            if not self._video.isOpened():
+                raise ValueError("failed to open the video writer of {}".format(self.outputPath))
+            return
+        self._file = open(self.outputPath, "wb")
+        if self.ext == ".gif":
+            # header with a 2-color (black) global color table for the background index, then the NETSCAPE2.0 loop extension
+            self._file.write(b"GIF89a" + struct.pack("<HHBBB", cols, rows, 0xF0, 0, 0) + b"\x00" * 6)
+            self._file.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+        else:
+            # RIFF size patched by close, VP8X with the animation (and alpha) flag, then ANIM
+            flags = 0x02 | (0x10 if _img.shape[2] == 4 else 0)
+            self._file.write(b"RIFF\x00\x00\x00\x00WEBP")
+            self._file.write(b"VP8X" + struct.pack("<IB3x", 10, flags) + struct.pack("<I", cols - 1)[:3] + struct.pack("<I", rows - 1)[:3])
+            self._file.write(b"ANIM" + struct.pack("<IIH", 6, 0, self.loop))
+
+    def _addGif(self, _img, _duration):
+        # a single-frame GIF from PIL (adaptive palette), its palette becomes the local color table of the frame
+        transparent = _img.shape[2] == 4 and np.amin(_img[:, :, 3]) < 255
+        frame = Image.fromarray(np.ascontiguousarray(_img[:, :, [2, 1, 0, 3]] if transparent else _img[:, :, 2::-1]))
+        buf = io.BytesIO()
+        frame.save(buf, "GIF")
+        data = buf.getvalue()
+        packed = data[10]
+        pos = 13
+        palette = b""
+        if packed & 0x80:
+            palette = data[pos:pos + (3 << ((packed & 0x07) + 1))]
+            pos += len(palette)
+        transparency = None
+        while data[pos] == 0x21:
+            if data[pos + 1] == 0xF9 and data[pos + 3] & 0x01:
+                transparency = data[pos + 6]
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+        descriptor = bytearray(data[pos:pos + 10])
+        if not descriptor[9] & 0x80:
+            descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (packed & 0x07)
+        else:
+            palette = b""
+        # graphic control extension: restore to background between transparent frames, otherwise keep
+        disposal = 2 if transparency is not None else 1
+        control = struct.pack("<BHB", (disposal << 2) | (transparency is not None), _duration, transparency or 0)
+        self._file.write(b"!\xf9\x04" + control + b"\x00" + bytes(descriptor) + palette + data[pos + 10:-1])
+
+    def _addWebp(self, _img, _duration):
+        # the ALPH and VP8/VP8L chunks of a still WebP from cv2, wrapped into an ANMF chunk without blending
+        data = self.factory.encodeImg(_img, ".webp", self.quality)
+        chunks = []
+        pos = 12
+        while pos + 8 <= len(data):
+            size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+            if data[pos:pos + 4] in (b"ALPH", b"VP8 ", b"VP8L"):
+                chunks.append(data[pos:pos + 8 + size] + b"\x00" * (size & 1))
+            pos += 8 + size + (size & 1)
+        payload = b"\x00" * 6 + struct.pack("<I", _img.shape[1] - 1)[:3] + struct.pack("<I", _img.shape[0] - 1)[:3] + struct.pack("<I", _duration)[:3] + b"\x02" + b"".join(chunks)
+        self._file.write(b"ANMF" + struct.pack("<I", len(payload)) + payload)
 
 class ImgFactory:
 
-    def __init__(self, _bgDim, _fgDim):
+    # version of the rendered pixels, bump it whenever a change alters the output of any method (keys of rendercache.RenderCache)
+    PIPELINE_VERSION = 1
+    # number of style LUTs kept by getStyleLUT, a 256-level table takes 48MB
+    LUT_CACHE_SIZE = 4
+    # max difference of each channel between getDomainColor and ColorThief, from decoding the image with cv2 instead of PIL
+    DOMAIN_COLOR_TOLERANCE = 2 / 255
+    # number of text layers kept by getTextImg and addText
+    TEXT_CACHE_SIZE = 256
+    # max bytes of a per-thread scratch buffer kept between the calls, larger temporaries are allocated per call
+    SCRATCH_BUFFER_BYTES = 64 * 1024 * 1024
+    # fonts loaded by getFont, keyed on (path, size)
+    _fontCache = {}
+    # guards _fontCache and the rasterization of the shared fonts, FreeType faces are not thread-safe
+    _fontLock = threading.Lock()
+
+    def __init__(self, _bgDim, _fgDim, _dtype = np.float64, _assetCache = None, _profiler = None, _reducedDecode = False, _fgIndex = None):
         """
         Parameters
         ----------
@@ -22,30 +719,95 @@ class ImgFactory:
             Background dimension, (248, 682) in general
         _fgDim: tuple (row, col)
             Foreground/Item dimension, (200, 200) in general
+        _dtype: numpy dtype
+            Working dtype of every pixel array, np.float64 (default), np.float32 or np.uint8
+            Pixel values are from 0.0 to 1.0 for the float types, and from 0 to 255 (fixed-point) for np.uint8
+        _assetCache: AssetCache
+            Optional cache serving readBg, readFg, readDct, readBanner and readIcon, can be shared by factories
+        _profiler: Profiler
+            Optional instrumentation of the public methods, can be shared by factories
+        _reducedDecode: bool
+            Let the readers decode sources without alpha at 1/2, 1/4 or 1/8 resolution (cv2.IMREAD_REDUCED_*) when that is still twice the target dimension
+            Much faster for large JPEG sources, but the pixels differ slightly from a full decode
+        _fgIndex: fgindex.FgIndex
+            Optional index of precomputed products serving readFg, readFgs, readFocusedFg and getDomainColor, see fgindex.buildFgIndex
+            It must be built for the same fgDim, dtype and _reducedDecode, the products missing from it (or changed since) are read as usual
         Returns
         ----------
         None
+        Notes
+        ----------
+        A factory can be shared by threads (e.g. a RenderPool): the caches are guarded by locks, and the renderers
+        write their temporaries into per-thread scratch buffers reused across the calls, see releaseScratch
+        The arrays returned by the readers and the caches are shared and read-only
         """
         self.bgDim = _bgDim
         self.fgDim = _fgDim
+        self.dtype = np.dtype(_dtype)
+        if self.dtype not in (np.float64, np.float32, np.uint8):
+            raise ValueError("unsupported working dtype: {}".format(self.dtype))
+        self.maxValue = 255 if self.dtype == np.uint8 else 1.0
+        self._lutCache = collections.OrderedDict()
+        self._lutSizeCache = {}
+        self.assetCache = _assetCache
+        self.profiler = _profiler
+        self._domainColorCache = {}
+        self._textCache = collections.OrderedDict()
+        self.reducedDecode = _reducedDecode
+        self._flattenLUTs = {}
+        self._lock = threading.Lock()
+        self._scratch = threading.local()
+        self.fgIndex = _fgIndex
+        if _fgIndex is not None:
+            _fgIndex.check(self)
 
-    def listDir(self, _dirPath):
+    @contextlib.contextmanager
+    def profile(self, _profiler = None):
+        """
+        Parameters
+        ----------
+        _profiler: Profiler
+            The profiler to be set during the context, a new one if None
+        Returns
+        ----------
+        Context manager
+            Yielding the profiler, the previous profiler of the factory is restored at exit
+        """
+        profiler = Profiler() if _profiler is None else _profiler
+        previous = self.profiler
+        self.profiler = profiler
+        try:
+            yield profiler
+        finally:
+            self.profiler = previous
+
+    def releaseScratch(self):
+        """
+        Free the scratch buffers of the renderers kept for the calling thread, e.g. after rendering a large img
+        """
+        self._scratch.__dict__.clear()
+
+    @_profiled
+    def listDir(self, _dirPath, _pattern = r".*\.png"):
         """
         Parameters
         ----------
         _dirPath: string
             Path of the directory
+        _pattern: string
+            Regular expression matched against the file names, png-images by default
         Returns
         ----------
         List
-            Containing the paths of the png-images in the directory
+            Containing the paths of the matched images in the directory
         """
         imgList = []
         for pngFile in os.listdir(_dirPath):
-            if not re.match(".*\.png", pngFile):    continue
+            if not re.match(_pattern, pngFile):    continue
             imgList.append( os.path.join(_dirPath, pngFile) )
         return imgList
 
+    @_profiled
     def getFont(self, _ttfPath, _size):
         """
         Parameters
@@ -57,25 +819,70 @@ class ImgFactory:
         Returns
         ----------
         ImageFont object
-            The corresponding ImageFont object
+            The corresponding ImageFont object, cached and shared by all the factories
         """
-        return ImageFont.truetype(os.path.join(_ttfPath), _size)
+        key = (os.path.abspath(_ttfPath), _size)
+        with ImgFactory._fontLock:
+            if key not in ImgFactory._fontCache:
+                ImgFactory._fontCache[key] = ImageFont.truetype(os.path.join(_ttfPath), _size)
+            return ImgFactory._fontCache[key]
 
-    def getDomainColor(self, _imgPath):
+    @_profiled
+    def getDomainColor(self, _imgPath, _stride = 1):
         """
         Parameters
         ----------
         _imgPath: string
             Path of the image
+        _stride: int
+            Only every _stride-th pixel is sampled, same as the quality of ColorThief
         Returns
         ----------
         3-elemented tuple
             Indicating (r, g, b), from 0.0 to 1.0
+            Agrees with ColorThief(_imgPath).get_color(quality = _stride) within DOMAIN_COLOR_TOLERANCE, see domaincheck.py
+            The result is memoized per (path, mtime, stride), or served from fgIndex
         """
-        r, g, b = ColorThief(_imgPath).get_color(quality = 1)
-        return (r / 255, g / 255, b / 255)
+        if self.fgIndex is not None:
+            rgb = self.fgIndex.getDomainColor(_imgPath, _stride)
+            if rgb is not None:
+                return rgb
+        path = os.path.abspath(_imgPath)
+        key = (path, os.stat(path).st_mtime_ns, _stride)
+        with self._lock:
+            if key in self._domainColorCache:
+                return self._domainColorCache[key]
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img.dtype == np.uint16:
+            img = np.uint8(img >> 8)
+        img = img.reshape(img.shape[0], img.shape[1], -1)
+        if img.shape[2] < 3:
+            img = np.concatenate([img[:, :, :1]] * 3 + [img[:, :, 1:]], axis = 2)
+        rgb = self._getDomainColor(img, _stride, True)
+        with self._lock:
+            self._domainColorCache[key] = rgb
+        return rgb
 
-    def dumpImg(self, _imgArr, _outputPath):
+    @_profiled
+    def getDomainColorArr(self, _imgArr, _stride = 1, _skipTransparent = True):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            The pixel values of the img, with shape (?, ?, 3) or (?, ?, 4) and value from 0.0 to 1.0
+        _stride: int
+            Only every _stride-th pixel is sampled
+        _skipTransparent: bool
+            Skip the pixels with alpha below 125 / 255
+        Returns
+        ----------
+        3-elemented tuple
+            Indicating (r, g, b), from 0.0 to 1.0
+        """
+        return self._getDomainColor(self._toUint8(_imgArr), _stride, _skipTransparent)
+
+    @_profiled
+    def dumpImg(self, _imgArr, _outputPath, _quality = None, _compression = None):
         """
         Parameters
         ----------
@@ -83,35 +890,58 @@ class ImgFactory:
             Pixel values of the image, from 0.0 to 1.0
         _outputPath: string
             Prefered path of the ouptut file
+        _quality: int
+            JPEG/WebP quality from 0 to 100, the encoder default if None
+        _compression: int
+            PNG compression level from 0 to 9, the encoder default if None
         Returns
         ----------
         None
         """
-        cv2.imwrite(_outputPath, _imgArr * 255)
+        cv2.imwrite(_outputPath, self._toImage(_imgArr), self._getEncodeParams(_outputPath, _quality, _compression))
+
+    @_profiled
+    def encodeImg(self, _imgArr, _ext, _quality = None, _compression = None):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            Pixel values of the image, from 0.0 to 1.0
+        _ext: string
+            Extension of the format, e.g. ".png", ".jpg" or ".webp"
+        _quality: int
+            JPEG/WebP quality from 0 to 100, the encoder default if None
+        _compression: int
+            PNG compression level from 0 to 9, the encoder default if None
+        Returns
+        ----------
+        bytes
+            The encoded image, e.g. to be served over HTTP without touching the disk
+        """
+        ok, buf = cv2.imencode(_ext, self._toImage(_imgArr), self._getEncodeParams(_ext, _quality, _compression))
+        if not ok:
+            raise ValueError("failed to encode the image as {}".format(_ext))
+        return buf.tobytes()
 
-    def readBg(self, _bgPath):
+    @_profiled
+    @_cachedAsset("bg")
+    def readBg(self, _bgPath, _withAlpha = True):
         """
         Parameters
         ----------
         _bgPath: string
             Path of the background file
+        _withAlpha: bool
+            Return the (always opaque) alpha channel, e.g. not needed when rendering into JPEG
         Returns
         ----------
         Numpy array
-            The pixel values of the bg, with shape (self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
+            The pixel values of the bg, with shape (self.bgDim[0], self.bgDim[1], 4) (3 without alpha) and value from 0.0 to 1.0
         """
-        bg = cv2.resize(cv2.imread(_bgPath, -1), (self.bgDim[1], self.bgDim[0]), interpolation = cv2.INTER_CUBIC) / 255
-        if bg.shape[2] < 4:
-            newBg = np.ones([bg.shape[0], bg.shape[1], 4])
-            newBg[:, :, :3] = bg[:, :, :3]
-            bg = newBg
-        else:
-            white = np.ones([bg.shape[0], bg.shape[1], 3])
-            bg[:, :, :3] = bg[:, :, :3] * bg[ :, :, [3] ] + white * (1 - bg[ :, :, [3] ])
-            bg[:, :, 3] = 1.
-        bg[:, :, :3] = np.clip(bg[:, :, :3] * 1.1, 0.0, 1.0)
-        return bg
+        return self._prepareBg( self._readResized(_bgPath, self.bgDim), _withAlpha )
 
+    @_profiled
+    @_cachedAsset("fg")
     def readFg(self, _fgPath):
         """
         Parameters
@@ -122,19 +952,42 @@ class ImgFactory:
         ----------
         Numpy array
             The pixel values of the fg, with shape (self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+            Only the alpha flattening is left if the fg is served from fgIndex
         """
-        fg = cv2.resize(cv2.imread(_fgPath, -1), (self.fgDim[1], self.fgDim[0]), interpolation = cv2.INTER_CUBIC) / 255
-        fg = fg.reshape(fg.shape[0], fg.shape[1], -1)
-        if fg.shape[2] < 4:
-            newFg = np.ones([fg.shape[0], fg.shape[1], 4])
-            newFg[:, :, :3] = fg[:, :, :3]
-            fg = newFg
-        else:
-            white = np.ones([fg.shape[0], fg.shape[1], 3])
-            fg[:, :, :3] = fg[:, :, :3] * fg[ :, :, [3] ] + white * (1 - fg[ :, :, [3] ])
-        fg[:, :, :3] = np.clip(fg[:, :, :3] * 1.05, 0.0, 1.0)
-        return fg
+        fg = None if self.fgIndex is None else self.fgIndex.getFg(_fgPath)
+        if fg is None:
+            fg = self._readResized(_fgPath, self.fgDim)
+        return self._flattenScaled( fg.reshape(fg.shape[0], fg.shape[1], -1), 1.05 )
+
+    @_profiled
+    def readFgs(self, _fgPaths):
+        """
+        Parameters
+        ----------
+        _fgPaths: list of string
+            Paths of the foreground/item files
+        Returns
+        ----------
+        Numpy array
+            The pixel values of the fgs, with shape (len(_fgPaths), self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+            Same values as readFg of each path, only the decoding and the resizing are done image by image
+        """
+        fgs = np.empty([len(_fgPaths), self.fgDim[0], self.fgDim[1], 4], dtype = np.uint8)
+        for idx, fgPath in enumerate(_fgPaths):
+            fg = None if self.fgIndex is None else self.fgIndex.getFg(fgPath)
+            if fg is None:
+                fg = self._readResized(fgPath, self.fgDim)
+            fg = fg.reshape(fg.shape[0], fg.shape[1], -1)
+            if fg.shape[2] < 4:
+                # an opaque alpha is flattened into the same values as the expansion of _flattenAlpha
+                fgs[idx, :, :, :3] = fg[:, :, :3]
+                fgs[idx, :, :, 3] = 255
+            else:
+                fgs[idx] = fg
+        return self._flattenScaled(fgs, 1.05)
 
+    @_profiled
+    @_cachedAsset("dct")
     def readDct(self, _dctPath):
         """
         Parameters
@@ -146,16 +999,10 @@ class ImgFactory:
         Numpy array
             The pixel values of the dct, with shape (self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
         """
-        dct = cv2.resize(cv2.imread(_dctPath, -1), (self.bgDim[1], self.bgDim[0]), interpolation = cv2.INTER_CUBIC) / 255
-        if dct.shape[2] < 4:
-            newDct = np.ones([dct.shape[0], dct.shape[1], 4])
-            newDct[:, :, :3] = dct[:, :, :3]
-            dct = newDct
-        else:
-            white = np.ones([dct.shape[0], dct.shape[1], 3])
-            dct[:, :, :3] = dct[:, :, :3] * dct[ :, :, [3] ] + white * (1 - dct[ :, :, [3] ])
-        return dct
+        return self._flattenScaled( self._readResized(_dctPath, self.bgDim), None )
 
+    @_profiled
+    @_cachedAsset("banner")
     def readBanner(self, _bannerPath):
         """
         Parameters
@@ -167,16 +1014,10 @@ class ImgFactory:
         Numpy array
             The pixel values of the banner, with shape (?, ?, 4) and value from 0.0 to 1.0
         """
-        banner = cv2.resize(cv2.imread(_bannerPath, -1), (self.bgDim[1], self.bgDim[0]), interpolation = cv2.INTER_CUBIC) / 255
-        if banner.shape[2] < 4:
-            newBanner = np.ones([banner.shape[0], banner.shape[1], 4])
-            newBanner[:, :, :3] = banner[:, :, :3]
-            banner = newBanner
-        else:
-            white = np.ones([banner.shape[0], banner.shape[1], 3])
-            banner[:, :, :3] = banner[:, :, :3] * banner[ :, :, [3] ] + white * (1 - banner[ :, :, [3] ])
-        return banner
+        return self._flattenScaled( self._readResized(_bannerPath, self.bgDim), None )
 
+    @_profiled
+    @_cachedAsset("icon")
     def readIcon(self, _iconPath, _dim):
         """
         Parameters
@@ -190,17 +1031,10 @@ class ImgFactory:
         Numpy array
             The pixel values of the icon, with shape (?, ?, 4) and value from 0.0 to 1.0
         """
-        icon = cv2.resize(cv2.imread(_iconPath, -1), (_dim[1], _dim[0]), interpolation = cv2.INTER_CUBIC) / 255
-        if icon.shape[2] < 4:
-            newIcon = np.ones([icon.shape[0], icon.shape[1], 4])
-            newIcon[:, :, :3] = icon[:, :, :3]
-            icon = newIcon
-        else:
-            white = np.ones([icon.shape[0], icon.shape[1], 3])
-            icon[:, :, :3] = icon[:, :, :3] * icon[ :, :, [3] ] + white * (1 - icon[ :, :, [3] ])
-        return icon
+        return self._flattenScaled( self._readResized(_iconPath, _dim), None )
 
-    def combineImg(self, _bg, _dct, _fg, _rowShift, _colShift):
+    @_profiled
+    def combineImg(self, _bg, _dct, _fg, _rowShift, _colShift, _out = None):
         """
         Parameters
         ----------
@@ -214,23 +1048,80 @@ class ImgFactory:
             Control the center of the foreground, mapping value [-1, 1] to the top/bottom
         _colShift: double
             Control the center of the foreground, mapping value [-1, 1] to the left/right
+        _out: numpy array
+            Optional destination with the shape of _bg, can be _bg itself to composite in place
         Returns
         ----------
         Numpy array
             The pixel values of the combined img, with shape (self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
         """
-        img = np.copy(_bg)
-        img[:, :, :3] = _dct[:, :, :3] * _dct[ :, :, [3] ] + img[:, :, :3] * (1 - _dct[ :, :, [3] ])
-        rowCenter = int( (self.bgDim[0] - 1.) * (_rowShift + 1.) / 2. )
-        colCenter = int( (self.bgDim[1] - 1.) * (_colShift + 1.) / 2. )
-        (rowMin, rowMax) = ( max(0, rowCenter - self.fgDim[0] // 2), min(rowCenter + self.fgDim[0] // 2, self.bgDim[0] - 1) )
-        (colMin, colMax) = ( max(0, colCenter - self.fgDim[1] // 2), min(colCenter + self.fgDim[1] // 2, self.bgDim[1] - 1) )
-        deltaRow = rowCenter - self.fgDim[0] // 2
-        deltaCol = colCenter - self.fgDim[1] // 2
-        fgCrop = _fg[rowMin - deltaRow:rowMax - deltaRow, colMin - deltaCol:colMax - deltaCol, :]
-        img[rowMin:rowMax, colMin:colMax, :3] = fgCrop[:, :, :3] * fgCrop[ :, :, [3] ] + img[rowMin:rowMax, colMin:colMax, :3] * (1 - fgCrop[ :, :, [3] ])
+        img = self._prepareOut(_bg, _out)
+        self._blendFull(img, _dct)
+        self._blendCentered(img, _fg, _rowShift, _colShift, self.bgDim, self.fgDim)
+        return img
+
+    @_profiled
+    def combineImgs(self, _bg, _dct, _fgs, _rowShift, _colShift, _out = None):
+        """
+        Parameters
+        ----------
+        _bg: numpy array
+            The pixel values of the background shared by the batch, with shape (self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
+        _dct: numpy array
+            The pixel values of the decorator shared by the batch, with shape (self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
+        _fgs: numpy array
+            The pixel values of the foregrounds/items, with shape (N, self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+        _rowShift: double
+            Control the center of the foregrounds, mapping value [-1, 1] to the top/bottom
+        _colShift: double
+            Control the center of the foregrounds, mapping value [-1, 1] to the left/right
+        _out: numpy array
+            Optional destination with shape (N, self.bgDim[0], self.bgDim[1], 4), e.g. reused across the chunks of a large batch
+        Returns
+        ----------
+        Numpy array
+            The pixel values of the combined imgs, with shape (N, self.bgDim[0], self.bgDim[1], 4) and value from 0.0 to 1.0
+            Same values as combineImg of each fg, the decorator is blended once and the foregrounds in one vectorized pass
+        """
+        base = self._prepareOut(_bg, None)
+        self._blendFull(base, _dct)
+        imgs = np.empty((len(_fgs),) + base.shape, dtype = base.dtype) if _out is None else _out
+        imgs[...] = base
+        region = self._getCenteredRegion(_rowShift, _colShift, self.bgDim, self.fgDim)
+        if region is not None:
+            imgSlice, layerSlice = region
+            fgCrop = _fgs[(slice(None),) + layerSlice]
+            self._blend(imgs[(slice(None),) + imgSlice + (slice(0, 3),)], fgCrop[..., :3], fgCrop[..., [3]])
+        return imgs
+
+    @_profiled
+    def compositeImg(self, _bg, _layers, _out = None):
+        """
+        Parameters
+        ----------
+        _bg: numpy array
+            The pixel values of the background, with shape (?, ?, 4) and value from 0.0 to 1.0
+        _layers: list of tuple (layer, rowShift, colShift)
+            The layers blended over _bg from bottom to top, with shape (?, ?, 4) and value from 0.0 to 1.0
+            (layer, None, None) => full-frame layer aligned with _bg, e.g. a decorator
+            (layer, rowShift, colShift) => layer centered like the foreground of combineImg or the text of addTextImg
+        _out: numpy array
+            Optional destination with the shape of _bg, can be _bg itself to composite in place
+        Returns
+        ----------
+        Numpy array
+            The pixel values of the composited img, with the same shape and value from 0.0 to 1.0
+            Every layer is blended only inside its bbox, so a whole banner takes at most one allocation
+        """
+        img = self._prepareOut(_bg, _out)
+        for layer, rowShift, colShift in _layers:
+            if rowShift is None:
+                self._blendFull(img, layer)
+            else:
+                self._blendCentered(img, layer, rowShift, colShift, img.shape[:2], layer.shape[:2])
         return img
 
+    @_profiled
     def renderImg(self, _imgArr, _domainRGB, _targetRGB, _styleID, _highS = False):
         """
         Parameters
@@ -248,28 +1139,253 @@ class ImgFactory:
         Numpy array
             The pixel values of the rendered img, with the same shape and value from 0.0 to 1.0
         """
-        domainH, domainS, _ = colorsys.rgb_to_hsv(_domainRGB[0], _domainRGB[1], _domainRGB[2])
-        targetH, targetS, targetV = colorsys.rgb_to_hsv(_targetRGB[0], _targetRGB[1], _targetRGB[2])
-        deltaH = targetH - domainH
-        if deltaH < 0:  deltaH = deltaH + 1
+        return next( self.renderImgs(_imgArr, _domainRGB, _targetRGB, [_styleID], _highS) )
+
+    @_profiled
+    def renderImgs(self, _imgArr, _domainRGB, _targetRGB, _styleIDs, _highS = False, _pool = None):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            The pixel values of the img, with shape (?, ?, 4) and value from 0.0 to 1.0
+        _domainRGB: 3-elemented tuple
+            Domain color of the input img, represented in (r, g, b), from 0.0 to 1.0
+        _targetRGB: 3-elemented tuple
+            Target style color, represented in (r, g, b), from 0.0 to 1.0
+        _styleIDs: iterable of style index
+            The styles to be rendered, see renderImg
+        _pool: RenderPool
+            Optional thread pool rendering the styles in parallel, at most twice its workers are in flight
+        Returns
+        ----------
+        Generator of numpy array
+            The pixel values of the rendered img for each style, in the order of _styleIDs
+            The img is converted into hsv only once and shared by all the styles
+        """
+        deltaH = self._getDeltaH(_domainRGB, _targetRGB)
+        srcHSV = self._getHSV(self._toFloat(_imgArr[:, :, 2::-1]), _highS)
+        if _pool is None:
+            for styleID in _styleIDs:
+                yield self._renderStyle(_imgArr, srcHSV, deltaH, styleID)
+            return
+        pending = collections.deque()
+        for styleID in _styleIDs:
+            pending.append( _pool.submit(self._renderStyle, _imgArr, srcHSV, deltaH, styleID) )
+            if len(pending) >= 2 * _pool.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    @_profiled
+    def renderImgsTiled(self, _imgArr, _domainRGB, _targetRGB, _styleIDs, _highS = False, _tileRows = 256, _outs = None):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            The pixel values of the img, with shape (?, ?, 4) and value from 0.0 to 1.0, e.g. a np.memmap
+        _domainRGB, _targetRGB, _styleIDs, _highS:
+            See renderImgs
+        _tileRows: int
+            Number of rows rendered at a time, the temporaries are bounded by the strip instead of the img
+        _outs: list of numpy array
+            Optional destinations with the shape of _imgArr (e.g. np.memmap), one per style
+        Returns
+        ----------
+        List
+            The pixel values of the rendered img for each style, the same as renderImgs since the hue rotation is per-pixel
+        """
+        outs = [np.empty_like(_imgArr) for _ in _styleIDs] if _outs is None else _outs
+        for rowStart in range(0, _imgArr.shape[0], _tileRows):
+            strip = _imgArr[rowStart:rowStart + _tileRows]
+            for out, rendered in zip(outs, self.renderImgs(strip, _domainRGB, _targetRGB, _styleIDs, _highS)):
+                out[rowStart:rowStart + _tileRows] = rendered
+        return outs
+
+    @_profiled
+    def renderFileTiled(self, _bgPath, _domainRGB, _targetRGB, _styleIDs, _outs, _highS = False, _tileRows = 256):
+        """
+        Parameters
+        ----------
+        _bgPath: string
+            Path of the background file, with the size of self.bgDim
+        _domainRGB, _targetRGB, _styleIDs, _highS:
+            See renderImgs
+        _outs: list of numpy array
+            Destinations with shape (self.bgDim[0], self.bgDim[1], 4) and dtype np.uint8 (e.g. np.memmap), one per style
+        _tileRows: int
+            Number of rows read and rendered at a time
+        Returns
+        ----------
+        List
+            _outs, with the 8-bit pixel values of readBg(_bgPath) rendered for each style, ready for dumpImg
+            Only the decoded 8-bit image and the temporaries of a strip are kept in memory, never the full float img
+        """
+        raw = cv2.imread(_bgPath, -1)
+        if raw.shape[:2] != tuple(self.bgDim):
+            raise ValueError("tiled rendering needs the image size {} to be the same as bgDim {}".format(raw.shape[:2], self.bgDim))
+        for rowStart in range(0, raw.shape[0], _tileRows):
+            strip = self._prepareBg(raw[rowStart:rowStart + _tileRows])
+            for out, rendered in zip(_outs, self.renderImgs(strip, _domainRGB, _targetRGB, _styleIDs, _highS)):
+                out[rowStart:rowStart + _tileRows] = self._toImage(rendered)
+        return _outs
+
+    @_profiled
+    def renderHueCycle(self, _imgArr, _domainRGB, _targetRGB, _frames, _highS = False, _pool = None):
+        """
+        Parameters
+        ----------
+        _imgArr, _domainRGB, _targetRGB, _highS, _pool:
+            See renderImgs
+        _frames: int
+            Number of frames of a full turn of the hue, e.g. 14 => the styles 0 to 13, 56 => 3 more steps between two styles
+        Returns
+        ----------
+        Generator of numpy array
+            The pixel values of each frame, the fractional styles 14 * k / _frames for k in range(_frames)
+            The img is converted into hsv only once, and the frames are rendered one at a time as they are consumed
+        """
+        if _frames < 1:
+            raise ValueError("number of frames must be positive: {}".format(_frames))
+        return self.renderImgs(_imgArr, _domainRGB, _targetRGB, (14 * k / _frames for k in range(_frames)), _highS, _pool)
+
+    @_profiled
+    def dumpHueCycle(self, _imgArr, _domainRGB, _targetRGB, _outputPath, _frames = 56, _fps = 25, _highS = False, _quality = None, _pool = None):
+        """
+        Parameters
+        ----------
+        _imgArr, _domainRGB, _targetRGB, _frames, _highS, _pool:
+            See renderHueCycle
+        _outputPath: string
+            Path of the animation, ".gif", ".webp", ".mp4" or ".avi", see AnimationWriter
+        _fps: double
+            Frames per second
+        _quality: int
+            WebP quality from 0 to 100, the encoder default if None
+        Returns
+        ----------
+        string
+            _outputPath, written frame by frame with a memory footprint independent of _frames
+        """
+        with AnimationWriter(self, _outputPath, _fps, _quality = _quality) as writer:
+            for frame in self.renderHueCycle(_imgArr, _domainRGB, _targetRGB, _frames, _highS, _pool):
+                writer.add(frame)
+        return _outputPath
+
+    @_profiled
+    def renderImgLUT(self, _imgArr, _domainRGB, _targetRGB, _styleID, _highS = False, _lutSize = 256, _maxError = None):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            The pixel values of the img, with shape (?, ?, 4) and value from 0.0 to 1.0
+        _domainRGB: 3-elemented tuple
+            Domain color of the input img, represented in (r, g, b), from 0.0 to 1.0
+        _targetRGB: 3-elemented tuple
+            Target style color, represented in (r, g, b), from 0.0 to 1.0
+        _styleID: style index
+            See renderImg
+        _lutSize: int
+            Number of levels per channel of the color LUT, 256 => exact 8-bit table with a single gather per pixel, less => trilinear interpolation
+        _maxError: double or None
+            If set, use the smallest LUT whose max error (value from 0.0 to 1.0) against renderImg is within _maxError, see getStyleLUT
+        Returns
+        ----------
+        Numpy array
+            The pixel values of the rendered img, with the same shape and value from 0.0 to 1.0
+            Float pixels are quantized to 8-bit before the lookup
+        """
+        if _maxError is not None:
+            _lutSize = self.getLUTSize(_domainRGB, _targetRGB, _styleID, _highS, _maxError)
+        lut = self.getStyleLUT(_domainRGB, _targetRGB, _styleID, _highS, _lutSize)
         img = np.copy(_imgArr)
-        hsv = matplotlib.colors.rgb_to_hsv(_imgArr[:, :, 2::-1])
-        # change h
-        hsv[ :, :, [0] ] = hsv[ :, :, [0] ] + (_styleID / 14)
-        exceed = (hsv[ :, :, [0] ] > 1.).astype(int)
-        hsv[ :, :, [0] ] = hsv[ :, :, [0] ] - exceed
-        hsv[ :, :, [0] ] = hsv[ :, :, [0] ] + deltaH
-        exceed = (hsv[ :, :, [0] ] > 1.).astype(int)
-        hsv[ :, :, [0] ] = hsv[ :, :, [0] ] - exceed
-        # change s
-        if _highS:
-            hsv[ :, :, [1] ] = hsv[ :, :, [1] ] + 0.05
-            hsv[ :, :, [1] ] = np.clip(hsv[ :, :, [1] ], 0.0, 1.0)
-        # change back
-        rgb = matplotlib.colors.hsv_to_rgb(hsv)
-        img[:, :, :3] = np.clip(rgb[:, :, 2::-1], 0.0, 1.0)
+        if _lutSize == 256:
+            bgr = self._toImage(_imgArr[:, :, :3]).astype(np.int32)
+            index = (bgr[:, :, 0] << 16) | (bgr[:, :, 1] << 8) | bgr[:, :, 2]
+            img[:, :, :3] = self._fromUint8( np.take(lut.reshape(-1, 3), index, axis = 0) )
+        else:
+            img[:, :, :3] = self._fromFloat( self._interpolateLUT(lut, self._toFloat(_imgArr[:, :, :3])) )
         return img
 
+    @_profiled
+    def getStyleLUT(self, _domainRGB, _targetRGB, _styleID, _highS = False, _lutSize = 256):
+        """
+        Parameters
+        ----------
+        _domainRGB: 3-elemented tuple
+            Domain color of the input img, represented in (r, g, b), from 0.0 to 1.0
+        _targetRGB: 3-elemented tuple
+            Target style color, represented in (r, g, b), from 0.0 to 1.0
+        _styleID: style index
+            See renderImg
+        _lutSize: int
+            Number of levels per channel
+        Returns
+        ----------
+        Numpy array
+            The color LUT indexed by [b, g, r], with shape (_lutSize, _lutSize, _lutSize, 3)
+            uint8 from 0 to 255 when _lutSize is 256, otherwise float32 from 0.0 to 1.0
+            The recently used tables are cached, see LUT_CACHE_SIZE
+        """
+        deltaH = self._getDeltaH(_domainRGB, _targetRGB)
+        key = (deltaH, _styleID, bool(_highS), _lutSize)
+        with self._lock:
+            if key in self._lutCache:
+                self._lutCache.move_to_end(key)
+                return self._lutCache[key]
+        if _lutSize == 256:
+            lut = np.empty([256, 256, 256, 3], dtype = np.uint8)
+            for b, bgr in self._iterColorSlabs():
+                rgb = self._shiftHue(self._getHSV(bgr[:, :, ::-1], _highS), deltaH, _styleID)
+                lut[b:b + 16] = np.rint(rgb * 255).reshape([16, 256, 256, 3])
+        else:
+            levels = np.linspace(0.0, 1.0, _lutSize)
+            bgr = np.stack(np.meshgrid(levels, levels, levels, indexing = "ij"), axis = 3).reshape([_lutSize * _lutSize, _lutSize, 3])
+            rgb = self._shiftHue(self._getHSV(bgr[:, :, ::-1], _highS), deltaH, _styleID)
+            lut = rgb.reshape([_lutSize, _lutSize, _lutSize, 3]).astype(np.float32)
+        lut.setflags(write = False)
+        with self._lock:
+            self._lutCache[key] = lut
+            while len(self._lutCache) > self.LUT_CACHE_SIZE:
+                self._lutCache.popitem(last = False)
+        return lut
+
+    @_profiled
+    def getLUTSize(self, _domainRGB, _targetRGB, _styleID, _highS, _maxError):
+        """
+        Parameters
+        ----------
+        _domainRGB, _targetRGB, _styleID, _highS:
+            See getStyleLUT
+        _maxError: double
+            Tolerated max error of each channel, value from 0.0 to 1.0
+        Returns
+        ----------
+        int
+            The smallest LUT size in (17, 33, 65, 129) whose max error over all the 8-bit colors is within _maxError, or 256 otherwise
+            The error is measured against the 256-level table once per style and memoized
+        """
+        deltaH = self._getDeltaH(_domainRGB, _targetRGB)
+        key = (deltaH, _styleID, bool(_highS), _maxError)
+        with self._lock:
+            if key in self._lutSizeCache:
+                return self._lutSizeCache[key]
+        exact = self.getStyleLUT(_domainRGB, _targetRGB, _styleID, _highS, 256)
+        lutSize = 256
+        for size in (17, 33, 65, 129):
+            lut = self.getStyleLUT(_domainRGB, _targetRGB, _styleID, _highS, size)
+            maxError = 0.5 / 255
+            for b, bgr in self._iterColorSlabs():
+                diff = self._interpolateLUT(lut, bgr) - exact[b:b + 16].reshape([-1, 256, 3]) / np.float32(255)
+                maxError = max(maxError, np.amax(np.abs(diff)) + 0.5 / 255)
+                if maxError > _maxError:    break
+            if maxError <= _maxError:
+                lutSize = size
+                break
+        with self._lock:
+            self._lutSizeCache[key] = lutSize
+        return lutSize
+
+    @_profiled
     def renderRGB(self, _targetRGB, _styleID):
         """
         Parameters
@@ -292,7 +1408,8 @@ class ImgFactory:
         #return (r * 0.6, g * 0.6, b * 0.6)
         return (r1, g1, b1), (r2 * 0.7, g2 * 0.7, b2 * 0.7), (r3, g3, b3)
 
-    def addText(self, _imgArr, _text, _font, _rgb, _rowShift, _colShift):
+    @_profiled
+    def addText(self, _imgArr, _text, _font, _rgb, _rowShift, _colShift, _out = None):
         """
         Parameters
         ----------
@@ -308,20 +1425,21 @@ class ImgFactory:
             Where the first letter appears, mapping value [-1, 1] to the top/bottom
         _colShift: double
             Where the first letter appears, mapping value [-1, 1] to the left/right
+        _out: numpy array
+            Optional destination with the shape of _imgArr, can be _imgArr itself to add the text in place
         Returns
         ----------
         Numpy array
             The pixel values of the img with text, with the same shape and value from 0.0 to 1.0
         """
-        pImg = Image.fromarray( np.uint8(_imgArr[:, :, :3] * 255) )
-        draw = ImageDraw.Draw(pImg)
         row = int( (_imgArr.shape[0] - 1.) * (_rowShift + 1.) / 2. )
         col = int( (_imgArr.shape[1] - 1.) * (_colShift + 1.) / 2. )
-        draw.text( (col, row), _text, ( int(_rgb[2] * 255), int(_rgb[1] * 255), int(_rgb[0] * 255) ), font = _font )
-        img = np.copy(_imgArr)
-        img[:, :, :3] = np.asarray(pImg)[:, :, :] / 255
+        img = self._prepareOut(_imgArr, _out)
+        # the text layer is drawn at (5, 5)
+        self._blendAt(img, self._getTextLayer(_text, _font, _rgb, _imgArr.shape[:2]), row - 5, col - 5)
         return img
 
+    @_profiled
     def bgra2Bgr(self, _imgArr):
         """
         Parameters
@@ -333,9 +1451,11 @@ class ImgFactory:
         Numpy array
             The pixel values of the 3-channeled img, with shape (?, ?, 3) and value from 0.0 to 1.0
         """
-        white = np.ones( [_imgArr.shape[0], _imgArr.shape[1], 3] )
-        return _imgArr[:, :, :3] * _imgArr[ :, :, [3] ] + white * (1 - _imgArr[ :, :, [3] ])
+        white = np.full( [_imgArr.shape[0], _imgArr.shape[1], 3], self.maxValue, dtype = self.dtype )
+        self._blend(white, _imgArr[:, :, :3], _imgArr[ :, :, [3] ])
+        return white
 
+    @_profiled
     def bgra2Gray(self, _imgArr):
         """
         Parameters
@@ -347,8 +1467,9 @@ class ImgFactory:
         Numpy array
             The pixel values of the gray-scale img, with shape (?, ?, 1) and value from 0.0 to 1.0
         """
-        return (cv2.cvtColor(np.uint8(_imgArr[:, :, :] * 255), cv2.COLOR_BGRA2GRAY) / 255).reshape([-1, _imgArr.shape[1], 1])
+        return self._fromUint8( cv2.cvtColor(self._toUint8(_imgArr[:, :, :]), cv2.COLOR_BGRA2GRAY) ).reshape([-1, _imgArr.shape[1], 1])
 
+    @_profiled
     def resizeImg(self, _imgArr, _dim):
         """
         Parameters
@@ -362,8 +1483,67 @@ class ImgFactory:
         Numpy array
             The pixel values of the resized img, with shape (?, ?, ?) and value from 0.0 to 1.0
         """
-        return cv2.resize(np.uint8(_imgArr[:, :, :] * 255), (_dim[1], _dim[0]), interpolation = cv2.INTER_CUBIC) / 255
+        return self._fromUint8( cv2.resize(self._toUint8(_imgArr[:, :, :]), (_dim[1], _dim[0]), interpolation = cv2.INTER_CUBIC) )
 
+    @_profiled
+    def resizePyramid(self, _imgArr, _dims):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            The pixel values of the img, with shape (?, ?, ?) and value from 0.0 to 1.0
+        _dims: list of tuple (row, col)
+            Output dimensions, e.g. the sizes served by a CDN
+        Returns
+        ----------
+        List
+            The pixel values of the img resized to each of _dims, in the same order
+            Each level is resized from the nearest larger level (or _imgArr), with area interpolation for downscales and in the working dtype
+        """
+        levels = {}
+        larger = [_imgArr]
+        for dim in sorted(set(tuple(dim) for dim in _dims), key = lambda dim: dim[0] * dim[1], reverse = True):
+            # the smallest level so far still covering dim in both directions
+            src = min((level for level in larger if level.shape[0] >= dim[0] and level.shape[1] >= dim[1]), key = lambda level: level.shape[0] * level.shape[1], default = _imgArr)
+            if src.shape[:2] == dim:
+                level = src
+            else:
+                downscale = src.shape[0] >= dim[0] and src.shape[1] >= dim[1]
+                level = cv2.resize(src, (dim[1], dim[0]), interpolation = cv2.INTER_AREA if downscale else cv2.INTER_CUBIC)
+                level = level.reshape(dim + src.shape[2:])
+                if level.dtype != np.uint8:
+                    np.clip(level, 0.0, 1.0, out = level)
+            levels[dim] = level
+            larger.append(level)
+        return [levels[tuple(dim)] for dim in _dims]
+
+    @_profiled
+    def dumpPyramid(self, _imgArr, _dims, _outputPath, _quality = None, _compression = None):
+        """
+        Parameters
+        ----------
+        _imgArr: numpy array
+            Pixel values of the image, from 0.0 to 1.0
+        _dims: list of tuple (row, col)
+            Output dimensions, see resizePyramid
+        _outputPath: string
+            Path of the output files, formatted with {rows} and {cols}, e.g. "/web/public/images/banner.{cols}x{rows}.png"
+        _quality: int
+            JPEG/WebP quality from 0 to 100, the encoder default if None
+        _compression: int
+            PNG compression level from 0 to 9, the encoder default if None
+        Returns
+        ----------
+        List
+            Containing the output path of each of _dims, the files are encoded and written together on an ImgWriter
+        """
+        outputPaths = [_outputPath.format(rows = dim[0], cols = dim[1]) for dim in _dims]
+        with ImgWriter(self, _workers = min(4, max(1, len(_dims))), _maxPending = max(1, len(_dims)), _quality = _quality, _compression = _compression) as writer:
+            for level, outputPath in zip(self.resizePyramid(_imgArr, _dims), outputPaths):
+                writer.submit(level, outputPath)
+        return outputPaths
+
+    @_profiled
     def getTextImg(self, _text, _font, _rgb):
         """
         Parameters
@@ -379,24 +1559,43 @@ class ImgFactory:
         Numpy array
             The pixel values of the img with text, with the same shape and value from 0.0 to 1.0
         """
-        pImg = Image.fromarray( np.uint8(np.ones([self.bgDim[0], self.bgDim[1], 3]) * 255) )
-        draw = ImageDraw.Draw(pImg)
-        draw.text( (5, 5), _text, ( int(_rgb[2] * 255), int(_rgb[1] * 255), int(_rgb[0] * 255) ), font = _font )
-        imgArr = np.asarray(pImg)
-        exist0 = (imgArr[:, :, 0] < 255).astype(int)
-        exist1 = (imgArr[:, :, 1] < 255).astype(int)
-        exist2 = (imgArr[:, :, 2] < 255).astype(int)
-        exist = ( (exist0 + exist1 + exist2) > 0 ).astype(int)
-        rowEnd = np.argmax(np.amax(exist, axis = 1) + np.arange(self.bgDim[0]) /self.bgDim[0]) + 5
-        colEnd = np.argmax(np.amax(exist, axis = 0) + np.arange(self.bgDim[1]) /self.bgDim[1]) + 5
-        img = np.zeros([rowEnd, colEnd, 4])
-        channelA = 1 - np.mean( ( imgArr[:rowEnd, :colEnd, :] / 255 - np.array([ _rgb[2], _rgb[1], _rgb[0] ]) ) ** 2, axis = 2 )
-        minChannelA = np.amin(channelA)
-        img[:, :, 3] = exist[:rowEnd, :colEnd] * (channelA - minChannelA) / (1 - minChannelA)
-        img[:, :, :3] = imgArr[:rowEnd, :colEnd, :] / 255
+        return self._getTextLayer(_text, _font, _rgb, self.bgDim)
+
+    def _getTextLayer(self, _text, _font, _rgb, _dim):
+        """
+        Text drawn at (5, 5) on a canvas of _dim, cropped 5 pixels after the last glyph pixel
+        The alpha is the grayscale glyph mask, rasterized only within the text bbox
+        The layers are cached (read-only) on text, font, color and _dim, see TEXT_CACHE_SIZE
+        """
+        fontKey = (_font.path, _font.size, _font.index) if isinstance(getattr(_font, "path", None), str) else _font
+        key = (_text, fontKey, tuple(_rgb), tuple(_dim), self.dtype.str)
+        with self._lock:
+            if key in self._textCache:
+                self._textCache.move_to_end(key)
+                return self._textCache[key]
+        with ImgFactory._fontLock:
+            # measured as drawn, i.e. with every line of a multiline text
+            right, bottom = ImageDraw.Draw(Image.new("L", (1, 1), 0)).multiline_textbbox( (5, 5), _text, font = _font )[2:]
+            canvasDim = ( max(1, min(_dim[0], bottom + 1)), max(1, min(_dim[1], right + 1)) )
+            mask = Image.new("L", (canvasDim[1], canvasDim[0]), 0)
+            ImageDraw.Draw(mask).text( (5, 5), _text, 255, font = _font )
+        mask = np.asarray(mask)
+        rows = np.flatnonzero(np.amax(mask, axis = 1))
+        cols = np.flatnonzero(np.amax(mask, axis = 0))
+        rowEnd = min(rows[-1] + 5, _dim[0]) if rows.size else 5
+        colEnd = min(cols[-1] + 5, _dim[1]) if cols.size else 5
+        img = np.zeros([rowEnd, colEnd, 4], dtype = self.dtype)
+        img[:, :, :3] = self._fromUint8(np.array([ int(_rgb[2] * 255), int(_rgb[1] * 255), int(_rgb[0] * 255) ], dtype = np.uint8))
+        img[:min(rowEnd, canvasDim[0]), :min(colEnd, canvasDim[1]), 3] = self._fromUint8(mask[:rowEnd, :colEnd])
+        img.setflags(write = False)
+        with self._lock:
+            self._textCache[key] = img
+            while len(self._textCache) > self.TEXT_CACHE_SIZE:
+                self._textCache.popitem(last = False)
         return img
 
-    def addTextImg(self, _imgArr, _textArr, _rowShift, _colShift):
+    @_profiled
+    def addTextImg(self, _imgArr, _textArr, _rowShift, _colShift, _out = None):
         """
         Parameters
         ----------
@@ -408,22 +1607,18 @@ class ImgFactory:
             Where the first letter appears, mapping value [-1, 1] to the top/bottom
         _colShift: double
             Where the first letter appears, mapping value [-1, 1] to the left/right
+        _out: numpy array
+            Optional destination with the shape of _imgArr, can be _imgArr itself to add the text in place
         Returns
         ----------
         Numpy array
             The pixel values of the img with text, with the same shape and value from 0.0 to 1.0
         """
-        img = np.copy(_imgArr)
-        rowCenter = int( (_imgArr.shape[0] - 1.) * (_rowShift + 1.) / 2. )
-        colCenter = int( (_imgArr.shape[1] - 1.) * (_colShift + 1.) / 2. )
-        (rowMin, rowMax) = ( max(0, rowCenter - _textArr.shape[0] // 2), min(rowCenter + _textArr.shape[0] // 2, _imgArr.shape[0] - 1) )
-        (colMin, colMax) = ( max(0, colCenter - _textArr.shape[1] // 2), min(colCenter + _textArr.shape[1] // 2, _imgArr.shape[1] - 1) )
-        deltaRow = rowCenter - _textArr.shape[0] // 2
-        deltaCol = colCenter - _textArr.shape[1] // 2
-        textArrCrop = _textArr[rowMin - deltaRow:rowMax - deltaRow, colMin - deltaCol:colMax - deltaCol, :]
-        img[rowMin:rowMax, colMin:colMax, :3] = textArrCrop[:, :, :3] * textArrCrop[ :, :, [3] ] + img[rowMin:rowMax, colMin:colMax, :3] * (1 - textArrCrop[ :, :, [3] ])
+        img = self._prepareOut(_imgArr, _out)
+        self._blendCentered(img, _textArr, _rowShift, _colShift, _imgArr.shape[:2], _textArr.shape[:2])
         return img
 
+    @_profiled
     def getFocusedFg(self, _fg):
         """
         Parameters
@@ -435,17 +1630,516 @@ class ImgFactory:
         Numpy array
             The pixel values of the focused fg, with shape (self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
         """
+        rowStart, rowEnd, colStart, colEnd = self._getFocusBox(_fg)
+        fgCrop = _fg[rowStart:rowEnd, colStart:colEnd, :]
+        return self._fromUint8( cv2.resize(self._toUint8(fgCrop), (self.fgDim[0], self.fgDim[1]), interpolation = cv2.INTER_CUBIC) )
+
+    @_profiled
+    def readFocusedFg(self, _fgPath):
+        """
+        Parameters
+        ----------
+        _fgPath: string
+            Path of the foreground/item file
+        Returns
+        ----------
+        Numpy array
+            The pixel values of getFocusedFg(readFg(_fgPath)), with shape (self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+            Served from fgIndex without cropping or resizing if the fg is indexed
+        """
+        focused = None if self.fgIndex is None else self.fgIndex.getFocusedFg(_fgPath)
+        if focused is None:
+            return self.getFocusedFg(self.readFg(_fgPath))
+        return self._fromUint8(focused)
+
+    @_profiled
+    def getFocusedFgs(self, _fgs):
+        """
+        Parameters
+        ----------
+        _fgs: numpy array
+            The pixel values of the foregrounds/items, with shape (N, self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+        Returns
+        ----------
+        Numpy array
+            The pixel values of the focused fgs, with shape (N, self.fgDim[0], self.fgDim[1], 4) and value from 0.0 to 1.0
+            Same values as getFocusedFg of each fg, only the resizing is done image by image
+        """
+        exist = _fgs[..., 3] > 0
+        top = np.count_nonzero(exist[:, :self.fgDim[0] // 2, :], axis = (1, 2))
+        bottom = np.count_nonzero(exist[:, self.fgDim[0] // 2:, :], axis = (1, 2))
+        colStart = self.fgDim[1] // 8
+        colEnd = self.fgDim[1] * 7 // 8
+        focused = np.empty([len(_fgs), self.fgDim[1], self.fgDim[0], 4], dtype = np.uint8)
+        for idxs, rowStart, rowEnd in ((np.flatnonzero(top > bottom), 0, self.fgDim[0] * 3 // 4), (np.flatnonzero(top <= bottom), self.fgDim[0] // 4, self.fgDim[0])):
+            fgCrops = self._toUint8(_fgs[idxs, rowStart:rowEnd, colStart:colEnd, :])
+            for idx, fgCrop in zip(idxs, fgCrops):
+                cv2.resize(fgCrop, (self.fgDim[0], self.fgDim[1]), focused[idx], interpolation = cv2.INTER_CUBIC)
+        return self._fromUint8(focused)
+
+    def _getFocusBox(self, _fg):
+        """
+        (rowStart, rowEnd, colStart, colEnd) of the getFocusedFg crop, the upper or lower 3/4 whichever has more opaque pixels
+        """
         exist = (_fg[:, :, 3] > 0.).astype(int)
         top = np.sum(exist[:self.fgDim[0] // 2, :])
         bottom = np.sum(exist[self.fgDim[0] // 2:, :])
         colStart = self.fgDim[1] // 8
         colEnd = self.fgDim[1] * 7 // 8
         if top > bottom:
-            rowStart = 0
-            rowEnd = self.fgDim[0] * 3 // 4
+            return 0, self.fgDim[0] * 3 // 4, colStart, colEnd
+        return self.fgDim[0] // 4, self.fgDim[0], colStart, colEnd
+
+    def _getDomainColor(self, _bgra, _stride, _skipTransparent):
+        """
+        Vectorized MMCQ (modified median cut quantization) on the 5-bit color histogram of 8-bit bgr(a) pixels
+        Follows colorthief 0.2.1, which skips the white pixels and returns the average color of the top box of a 5-color palette
+        """
+        pixels = _bgra.reshape(-1, _bgra.shape[2])[::_stride]
+        valid = ~np.all(pixels[:, :3] > 250, axis = 1)
+        if _skipTransparent and pixels.shape[1] > 3:
+            valid &= pixels[:, 3] >= 125
+        pixels = pixels[valid, :3] >> 3
+        if pixels.shape[0] == 0:
+            raise ValueError("no opaque and non-white pixel to extract the domain color")
+        index = (pixels[:, 2].astype(np.int32) << 10) | (pixels[:, 1].astype(np.int32) << 5) | pixels[:, 0]
+        histo = np.bincount(index, minlength = 32 ** 3).reshape([32, 32, 32])
+        # boxes of (r1, r2, g1, g2, b1, b2), in the order of ColorThief's priority queues
+        count = lambda box: int(np.sum(histo[box[0]:box[1] + 1, box[2]:box[3] + 1, box[4]:box[5] + 1]))
+        volume = lambda box: (box[1] - box[0] + 1) * (box[3] - box[2] + 1) * (box[5] - box[4] + 1)
+        box = [int(np.amin(pixels[:, 2])), int(np.amax(pixels[:, 2])), int(np.amin(pixels[:, 1])), int(np.amax(pixels[:, 1])), int(np.amin(pixels[:, 0])), int(np.amax(pixels[:, 0]))]
+        boxes = [box]
+        def split(_key, _target):
+            nColor = 1
+            for _ in range(1000):
+                boxes.sort(key = _key)
+                box = boxes.pop()
+                if not count(box):
+                    boxes.append(box)
+                    continue
+                box1, box2 = self._medianCut(histo, box, count(box))
+                boxes.append(box1)
+                if box2 is not None:
+                    boxes.append(box2)
+                    nColor += 1
+                if nColor >= _target:
+                    return
+        split(count, 0.75 * 5)
+        # ColorThief moves the boxes into the second queue by popping the first one (sorted by count once), i.e. in reversed
+        # (stable) count order, which breaks the ties of the count * volume sort below
+        boxes.sort(key = count)
+        boxes.reverse()
+        byVolume = lambda box: count(box) * volume(box)
+        split(byVolume, 5 - len(boxes))
+        boxes.sort(key = byVolume)
+        r1, r2, g1, g2, b1, b2 = boxes[-1]
+        sub = histo[r1:r2 + 1, g1:g2 + 1, b1:b2 + 1]
+        total = int(np.sum(sub))
+        avg = []
+        for axis, (c1, c2) in enumerate(((r1, r2), (g1, g2), (b1, b2))):
+            if total:
+                weights = np.sum(sub, axis = tuple(a for a in range(3) if a != axis))
+                avg.append( int(np.sum(weights * (2 * np.arange(c1, c2 + 1) + 1))) * 4 // total )
+            else:
+                avg.append( int(8 * (c1 + c2 + 1) / 2) )
+        return (avg[0] / 255, avg[1] / 255, avg[2] / 255)
+
+    def _medianCut(self, _histo, _box, _count):
+        """
+        Split the box along its longest axis at the median, returns (box1, box2 or None)
+        """
+        if _count == 1:
+            return list(_box), None
+        widths = [_box[1] - _box[0] + 1, _box[3] - _box[2] + 1, _box[5] - _box[4] + 1]
+        axis = widths.index(max(widths))
+        sub = _histo[_box[0]:_box[1] + 1, _box[2]:_box[3] + 1, _box[4]:_box[5] + 1]
+        c1, c2 = _box[2 * axis], _box[2 * axis + 1]
+        cumsum = np.cumsum(np.sum(sub, axis = tuple(a for a in range(3) if a != axis)))
+        partialSum = {c1 + i: int(total) for i, total in enumerate(cumsum)}
+        total = int(cumsum[-1])
+        for i in range(c1, c2 + 1):
+            if partialSum[i] > total / 2:
+                left = i - c1
+                right = c2 - i
+                if left <= right:
+                    d2 = min([c2 - 1, int(i + right / 2)])
+                else:
+                    d2 = max([c1, int(i - 1 - left / 2)])
+                # avoid 0-count boxes
+                while not partialSum.get(d2, False):
+                    d2 += 1
+                while not total - partialSum[d2] and partialSum.get(d2 - 1, False):
+                    d2 -= 1
+                box1, box2 = list(_box), list(_box)
+                box1[2 * axis + 1] = d2
+                box2[2 * axis] = d2 + 1
+                return box1, box2
+        return None, None
+
+    def _renderStyle(self, _imgArr, _srcHSV, _deltaH, _styleID):
+        """
+        One style of renderImgs, a copy of _imgArr with the rgb channels from the hue-shifted _srcHSV
+        """
+        img = np.copy(_imgArr)
+        if img.dtype == self.dtype and self.dtype != np.uint8:
+            self._shiftHue(_srcHSV, _deltaH, _styleID, img[:, :, :3])
         else:
-            rowStart = self.fgDim[0] // 4
-            rowEnd = self.fgDim[0]
-        fgCrop = _fg[rowStart:rowEnd, colStart:colEnd, :]
-        return cv2.resize(np.uint8(fgCrop * 255), (self.fgDim[0], self.fgDim[1]), interpolation = cv2.INTER_CUBIC) / 255
+            img[:, :, :3] = self._fromFloat(self._shiftHue(_srcHSV, _deltaH, _styleID))
+        return img
+
+    def _getDeltaH(self, _domainRGB, _targetRGB):
+        """
+        Hue offset from the domain color to the target color, from 0.0 to 1.0
+        """
+        domainH, domainS, _ = colorsys.rgb_to_hsv(_domainRGB[0], _domainRGB[1], _domainRGB[2])
+        targetH, targetS, targetV = colorsys.rgb_to_hsv(_targetRGB[0], _targetRGB[1], _targetRGB[2])
+        deltaH = targetH - domainH
+        if deltaH < 0:  deltaH = deltaH + 1
+        return deltaH
+
+    def _getHSV(self, _rgb, _highS):
+        """
+        Convert float rgb pixels into hsv, raising the saturation if _highS
+        """
+        hsv = self._rgbToHsv(_rgb)
+        # change s
+        if _highS:
+            hsv[ :, :, [1] ] = hsv[ :, :, [1] ] + 0.05
+            hsv[ :, :, [1] ] = np.clip(hsv[ :, :, [1] ], 0.0, 1.0)
+        return hsv
+
+    def _shiftHue(self, _srcHSV, _deltaH, _styleID, _out = None):
+        """
+        Rotate the hue of the hsv pixels by the style and _deltaH, and convert back into float bgr pixels (written into _out if given)
+        """
+        hsv = self._getScratch("hsv", _srcHSV.shape, _srcHSV.dtype)
+        np.copyto(hsv, _srcHSV)
+        h = hsv[:, :, 0]
+        exceed = self._getScratch("mask", h.shape, np.bool_)
+        # change h
+        h += _styleID / 14
+        np.subtract(h, 1., out = h, where = np.greater(h, 1., out = exceed))
+        h += _deltaH
+        np.subtract(h, 1., out = h, where = np.greater(h, 1., out = exceed))
+        # change back
+        rgb = self._hsvToRgb(hsv, self._getScratch("rgb", hsv.shape, hsv.dtype))
+        return np.clip(rgb[:, :, 2::-1], 0.0, 1.0, out = _out)
+
+    def _rgbToHsv(self, _rgb):
+        """
+        Convert float rgb pixels into hsv, the same arithmetic (and values) as matplotlib.colors.rgb_to_hsv
+        """
+        rgb = _rgb.astype(np.promote_types(_rgb.dtype, np.float32), copy = False)
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        maxV = rgb.max(-1)
+        delta = maxV - rgb.min(-1)
+        hsv = np.empty_like(rgb)
+        hsv[..., 1] = 0
+        np.divide(delta, maxV, out = hsv[..., 1], where = maxV > 0)
+        # blue wins over green and green over red when they are equal to max
+        isGray = delta == 0
+        delta[isGray] = 1
+        h = np.where(b == maxV, 4. + (r - g) / delta, np.where(g == maxV, 2. + (b - r) / delta, (g - b) / delta))
+        h[isGray] = 0
+        hsv[..., 0] = (h / 6.0) % 1.0
+        hsv[..., 2] = maxV
+        return hsv
+
+    def _hsvToRgb(self, _hsv, _out = None):
+        """
+        Convert hsv pixels into float rgb (written into _out if given), the same arithmetic (and values) as matplotlib.colors.hsv_to_rgb
+        The temporaries are per-thread scratch buffers, see _getScratch
+        """
+        hsv = _hsv.astype(np.promote_types(_hsv.dtype, np.float32), copy = False)
+        h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+        shape = h.shape
+        # i = int(6h) and f = 6h - i, which is float64 (as int64 promotes) even for float32 pixels
+        h6 = np.multiply(h, 6.0, out = self._getScratch("h6", shape, h.dtype))
+        i = self._getScratch("i", shape, np.dtype(int))
+        np.copyto(i, h6, casting = "unsafe")
+        f = np.subtract(h6, i, out = self._getScratch("f", shape, np.result_type(h6, i)))
+        p = np.subtract(1.0, s, out = h6)
+        np.multiply(v, p, out = p)
+        q = np.multiply(s, f, out = self._getScratch("q", shape, f.dtype))
+        np.subtract(1.0, q, out = q)
+        np.multiply(v, q, out = q)
+        t = np.subtract(1.0, f, out = f)
+        np.multiply(s, t, out = t)
+        np.subtract(1.0, t, out = t)
+        np.multiply(v, t, out = t)
+        sector = np.remainder(i, 6, out = i)
+        rgb = np.empty_like(hsv) if _out is None else _out
+        mask = self._getScratch("sector", shape, np.bool_)
+        # (r, g, b) of each hue sector, written with masked copies instead of fancy indexing
+        for k, channels in enumerate( ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)) ):
+            np.equal(sector, k, out = mask)
+            for c, src in enumerate(channels):
+                np.copyto(rgb[..., c], src, casting = "same_kind", where = mask)
+        gray = np.equal(s, 0, out = mask)
+        for c in range(3):
+            np.copyto(rgb[..., c], v, where = gray)
+        return rgb
+
+    def _getScratch(self, _name, _shape, _dtype):
+        """
+        Per-thread buffer of the renderers reused across the calls, reallocated when the shape or dtype changes
+        Buffers above SCRATCH_BUFFER_BYTES are not kept
+        """
+        buffers = self._scratch.__dict__
+        buf = buffers.get(_name)
+        if buf is None or buf.shape != tuple(_shape) or buf.dtype != _dtype:
+            buf = np.empty(_shape, dtype = _dtype)
+            if buf.nbytes <= self.SCRATCH_BUFFER_BYTES:
+                buffers[_name] = buf
+            else:
+                buffers.pop(_name, None)
+        return buf
+
+    def _iterColorSlabs(self):
+        """
+        Iterate over all the 8-bit colors as float bgr pixels, 16 blue levels (with shape (4096, 256, 3)) at a time
+        """
+        grid = np.stack(np.meshgrid(np.arange(16), np.arange(256), np.arange(256), indexing = "ij"), axis = 3).reshape([-1, 256, 3])
+        for b in range(0, 256, 16):
+            bgr = grid + np.array([b, 0, 0])
+            yield b, bgr / 255
+
+    def _interpolateLUT(self, _lut, _bgr):
+        """
+        Look up float bgr pixels from 0.0 to 1.0 in a coarse color LUT with trilinear interpolation
+        """
+        lutSize = _lut.shape[0]
+        pos = np.clip(_bgr, 0.0, 1.0) * (lutSize - 1)
+        index = np.minimum(pos.astype(np.int32), lutSize - 2)
+        frac = (pos - index).astype(np.float32)
+        flat = _lut.reshape(-1, 3)
+        base = (index[:, :, 0] * lutSize + index[:, :, 1]) * lutSize + index[:, :, 2]
+        result = np.zeros(_bgr.shape[:2] + (3,), dtype = np.float32)
+        for db in (0, 1):
+            wb = frac[:, :, [0]] if db else 1 - frac[:, :, [0]]
+            for dg in (0, 1):
+                wg = frac[:, :, [1]] if dg else 1 - frac[:, :, [1]]
+                for dr in (0, 1):
+                    wr = frac[:, :, [2]] if dr else 1 - frac[:, :, [2]]
+                    offset = (db * lutSize + dg) * lutSize + dr
+                    result += wb * wg * wr * np.take(flat, base + offset, axis = 0)
+        return result
+
+    def _blendAt(self, _imgArr, _layer, _top, _left):
+        """
+        Alpha-blend the layer over _imgArr in place, with its top-left corner at (_top, _left)
+        Only the overlapping region is touched
+        """
+        rowMin, rowMax = max(0, _top), min(_imgArr.shape[0], _top + _layer.shape[0])
+        colMin, colMax = max(0, _left), min(_imgArr.shape[1], _left + _layer.shape[1])
+        if rowMin >= rowMax or colMin >= colMax:
+            return
+        layerCrop = _layer[rowMin - _top:rowMax - _top, colMin - _left:colMax - _left, :]
+        self._blend(_imgArr[rowMin:rowMax, colMin:colMax, :3], layerCrop[:, :, :3], layerCrop[ :, :, [3] ])
+
+    def _prepareOut(self, _imgArr, _out):
+        """
+        Copy _imgArr into _out (allocated if None) unless they are the same array
+        """
+        if _out is None:
+            return np.copy(_imgArr)
+        if _out is not _imgArr:
+            _out[...] = _imgArr
+        return _out
+
+    def _blendFull(self, _imgArr, _layer):
+        """
+        Alpha-blend a full-frame layer over _imgArr in place, skipping the rows/cols outside the bbox of non-zero alpha
+        """
+        rows = np.flatnonzero(np.any(_layer[:, :, 3] > 0, axis = 1))
+        if rows.size == 0:
+            return
+        cols = np.flatnonzero(np.any(_layer[rows[0]:rows[-1] + 1, :, 3] > 0, axis = 0))
+        self._blendAt(_imgArr, _layer[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1, :], rows[0], cols[0])
+
+    def _blendCentered(self, _imgArr, _layer, _rowShift, _colShift, _imgDim, _layerDim):
+        """
+        Alpha-blend the layer over _imgArr in place, centered at the shifts
+        The last row/col of _imgDim is never covered and a layer of odd size loses its last row/col
+        """
+        region = self._getCenteredRegion(_rowShift, _colShift, _imgDim, _layerDim)
+        if region is None:
+            return
+        imgSlice, layerSlice = region
+        layerCrop = _layer[layerSlice]
+        self._blend(_imgArr[imgSlice + (slice(0, 3),)], layerCrop[:, :, :3], layerCrop[ :, :, [3] ])
+
+    def _getCenteredRegion(self, _rowShift, _colShift, _imgDim, _layerDim):
+        """
+        (rows, cols) slices of the image and of the layer covered by a layer centered at the shifts, or None if empty
+        The last row/col of _imgDim is never covered and a layer of odd size loses its last row/col
+        """
+        rowCenter = int( (_imgDim[0] - 1.) * (_rowShift + 1.) / 2. )
+        colCenter = int( (_imgDim[1] - 1.) * (_colShift + 1.) / 2. )
+        (rowMin, rowMax) = ( max(0, rowCenter - _layerDim[0] // 2), min(rowCenter + _layerDim[0] // 2, _imgDim[0] - 1) )
+        (colMin, colMax) = ( max(0, colCenter - _layerDim[1] // 2), min(colCenter + _layerDim[1] // 2, _imgDim[1] - 1) )
+        if rowMin >= rowMax or colMin >= colMax:
+            return None
+        deltaRow = rowCenter - _layerDim[0] // 2
+        deltaCol = colCenter - _layerDim[1] // 2
+        return (slice(rowMin, rowMax), slice(colMin, colMax)), (slice(rowMin - deltaRow, rowMax - deltaRow), slice(colMin - deltaCol, colMax - deltaCol))
+
+    def _getEncodeParams(self, _path, _quality, _compression):
+        """
+        cv2 encoder params of the format of _path (or extension)
+        """
+        ext = os.path.splitext(_path)[1].lower() or _path.lower()
+        params = []
+        if _quality is not None and ext in (".jpg", ".jpeg"):
+            params += [cv2.IMWRITE_JPEG_QUALITY, int(_quality)]
+        if _quality is not None and ext == ".webp":
+            params += [cv2.IMWRITE_WEBP_QUALITY, int(_quality)]
+        if _compression is not None and ext == ".png":
+            params += [cv2.IMWRITE_PNG_COMPRESSION, int(_compression)]
+        return params
+
+    def _prepareBg(self, _arr, _withAlpha = True):
+        """
+        Per-pixel part of readBg on the resized 8-bit pixels: flatten the alpha and brighten by 1.1, with an opaque alpha
+        """
+        return self._flattenScaled(_arr, 1.1, True if _withAlpha else None)
+
+    def _readResized(self, _path, _dim):
+        """
+        Decode the image unchanged (reduced for self.reducedDecode) and cubic-resize it to _dim, skipping the resize if it is already _dim
+        """
+        flags = cv2.IMREAD_UNCHANGED
+        if self.reducedDecode:
+            with Image.open(_path) as header:
+                (w, h), mode, info = header.size, header.mode, header.info
+            # IMREAD_REDUCED_* drops the alpha, and the high bit depths are kept as they are
+            # it also applies the EXIF orientation, ignored like IMREAD_UNCHANGED so that the decode matches the (unrotated) header size
+            if mode in ("1", "L", "P", "RGB", "CMYK", "YCbCr") and "transparency" not in info:
+                for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                    if h // factor >= 2 * _dim[0] and w // factor >= 2 * _dim[1]:
+                        flags = flag | cv2.IMREAD_IGNORE_ORIENTATION
+                        break
+        img = cv2.imread(_path, flags)
+        if img.shape[:2] == (_dim[0], _dim[1]):
+            return img
+        return cv2.resize(img, (_dim[1], _dim[0]), interpolation = cv2.INTER_CUBIC)
+
+    def _flattenScaled(self, _arr, _factor, _opaque = False):
+        """
+        _flattenAlpha and _scale(_factor) of the rgb (None => no scale) on 8-bit pixels (?, ..., ?, 1/3/4), in one table lookup per value
+        The alpha becomes opaque if _opaque, and is dropped if _opaque is None
+        The table is built by the same helpers, so the values are the same as calling them one after the other
+        """
+        if _arr.dtype != np.uint8 or _arr.shape[-1] not in (1, 3, 4):
+            # e.g. 16-bit images, through the helpers
+            arr = self._flattenAlpha( self._fromUint8(_arr) )
+            if _opaque is not False:
+                arr[..., 3] = self.maxValue
+            if _factor is not None:
+                arr[..., :3] = self._scale(arr[..., :3], _factor)
+            return arr if _opaque is not None else arr[..., :3]
+        lut = self._getFlattenLUT(_factor)
+        out = np.empty(_arr.shape[:-1] + (3 if _opaque is None else 4,), dtype = self.dtype)
+        if _arr.shape[-1] < 4:
+            out[..., :3] = lut[255][_arr[..., :3]]
+        else:
+            out[..., :3] = lut.ravel()[(_arr[..., 3:].astype(np.uint16) << 8) | _arr[..., :3]]
+        if _opaque is None:
+            return out
+        if _opaque or _arr.shape[-1] < 4:
+            out[..., 3] = self.maxValue
+        else:
+            out[..., 3] = self._fromUint8(_arr[..., 3])
+        return out
+
+    def _getFlattenLUT(self, _factor):
+        """
+        (alpha, 8-bit value) => value after _flattenAlpha and _scale(_factor), evaluated once on all the 256 x 256 combinations
+        """
+        lut = self._flattenLUTs.get(_factor)
+        if lut is None:
+            grid = np.empty([256, 256, 4], dtype = np.uint8)
+            grid[:, :, :3] = np.arange(256, dtype = np.uint8)[None, :, None]
+            grid[:, :, 3] = np.arange(256, dtype = np.uint8)[:, None]
+            flat = self._flattenAlpha( self._fromUint8(grid) )[:, :, :3]
+            if _factor is not None:
+                flat = self._scale(flat, _factor)
+            lut = np.ascontiguousarray(flat[:, :, 0])
+            with self._lock:
+                lut = self._flattenLUTs.setdefault(_factor, lut)
+        return lut
+
+    def _fromUint8(self, _arr):
+        """
+        Convert an 8-bit array (from cv2/PIL) into the working dtype
+        """
+        if self.dtype == np.uint8:
+            return _arr
+        arr = _arr.astype(self.dtype)
+        arr /= 255
+        return arr
+
+    def _toUint8(self, _arr):
+        """
+        Convert an array of the working dtype into 8-bit, truncating the fraction
+        """
+        if _arr.dtype == np.uint8:
+            return _arr
+        return np.uint8(_arr * 255)
+
+    def _toImage(self, _arr):
+        """
+        Convert an array of the working dtype into 8-bit for encoding, rounding to the nearest value
+        """
+        if _arr.dtype == np.uint8:
+            return _arr
+        return np.uint8( np.clip(np.rint(_arr * 255), 0, 255) )
+
+    def _toFloat(self, _arr):
+        """
+        Convert an array of the working dtype into floating point from 0.0 to 1.0
+        """
+        if _arr.dtype == np.uint8:
+            return _arr.astype(np.float32) / 255
+        return _arr
+
+    def _fromFloat(self, _arr):
+        """
+        Convert a floating point array from 0.0 to 1.0 into the working dtype
+        """
+        if self.dtype == np.uint8:
+            return np.uint8( np.clip(np.rint(_arr * 255), 0, 255) )
+        return _arr.astype(self.dtype, copy = False)
+
+    def _scale(self, _arr, _factor):
+        """
+        Multiply the pixel values by _factor and clip into the valid range
+        """
+        if self.dtype == np.uint8:
+            return np.uint8( np.clip(np.rint(_arr * np.float32(_factor)), 0, 255) )
+        return np.clip(_arr * _factor, 0.0, 1.0)
+
+    def _blend(self, _dst, _src, _alpha):
+        """
+        Alpha-blend _src over _dst in place, with _alpha of shape (?, ?, 1)
+        The uint8 dtype blends in 16-bit fixed-point: (src * a + dst * (255 - a) + 127) // 255
+        """
+        if self.dtype == np.uint8:
+            alpha = _alpha.astype(np.uint16)
+            _dst[...] = (_src * alpha + _dst * (255 - alpha) + 127) // 255
+        else:
+            _dst[...] = _src * _alpha + _dst * (1 - _alpha)
+
+    def _flattenAlpha(self, _arr):
+        """
+        Expand the array (or a stack of arrays) into 4 channels, blending the transparent pixels with white
+        """
+        if _arr.shape[-1] < 4:
+            newArr = np.full(_arr.shape[:-1] + (4,), self.maxValue, dtype = self.dtype)
+            newArr[..., :3] = _arr[..., :3]
+            return newArr
+        white = np.full(_arr.shape[:-1] + (3,), self.maxValue, dtype = self.dtype)
+        self._blend(white, _arr[..., :3], _arr[..., [3]])
+        _arr[..., :3] = white
+        return _arr
 
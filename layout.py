@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+
+import os
+from imgfactory import ImgFactory
+
+# layer types of a layout spec and the ImgFactory reader of each asset type
+LAYER_TYPES = ("bg", "dct", "banner", "fg", "text")
+READERS = {"bg": "readBg", "dct": "readDct", "banner": "readBanner"}
+
+def compileLayout(_spec, _assetCache = None, _fgIndex = None):
+    """
+    Parameters
+    ----------
+    _spec: dict
+        The layout spec (e.g. loaded from JSON), in the form of
+        {
+            "bgDim": [248, 682], "fgDim": [200, 200],
+            "assets": {"bg": "/data/irene_bgs/b001.png", "bubble": "/data/irene_dcts/bubble-d-01.png"},
+            "fonts": {"title": ["fonts/Pacifico.ttf", 50]},
+            "variants": [{
+                "output": "/web/public/images/{product}.colormap{variant}.png",
+                "resize": [40, 95],
+                "layers": [
+                    {"type": "bg", "asset": "bg", "style": 0},
+                    {"type": "dct", "asset": "bubble", "style": 1},
+                    {"type": "fg", "row": 0.0, "col": -0.6, "focused": false},
+                    {"type": "text", "text": "Best Bag Forever", "font": "title", "color": 3, "row": -0.3, "col": -0.1}
+                ]
+            }]
+        }
+        The first layer of each variant is the background ("bg" or "banner"), the others are blended over it in order
+        "style" is the styleID of renderImg against the product's domain color, None (or missing) keeps the asset as it is
+        "color" of text is either (r, g, b) from 0.0 to 1.0, or a styleID of renderRGB with an optional "shade" index (0 - 2)
+        "anchor" of text is "topleft" (default, see addText) or "center" (see addTextImg)
+        "resize" is optional, "output" is formatted with {product} (file name without extension), {index} and {variant}
+    _assetCache: AssetCache
+        Optional cache of the factory readers, e.g. shared with other plans
+    _fgIndex: fgindex.FgIndex
+        Optional index of the products of the fgDim, serving their reads, focused crops and domain colors
+    Returns
+    ----------
+    RenderPlan
+        The compiled plan, run it with RenderPlan.run
+    """
+    plan = RenderPlan(ImgFactory(tuple(_spec["bgDim"]), tuple(_spec["fgDim"]), _assetCache = _assetCache, _fgIndex = _fgIndex))
+    plan.spec = _spec
+    assets = _spec.get("assets", {})
+    fonts = _spec.get("fonts", {})
+    for name, (ttfPath, size) in fonts.items():
+        plan.fonts[name] = (ttfPath, size)
+    for variantIdx, variant in enumerate(_spec["variants"]):
+        layers = variant["layers"]
+        if not layers or layers[0]["type"] not in ("bg", "banner"):
+            raise ValueError("variant {}: the first layer must be a bg or banner".format(variantIdx))
+        ops = []
+        for layer in layers:
+            layerType = layer["type"]
+            if layerType not in LAYER_TYPES:
+                raise ValueError("variant {}: unknown layer type {}".format(variantIdx, layerType))
+            if layerType in READERS:
+                if layer["asset"] not in assets:
+                    raise ValueError("variant {}: unknown asset {}".format(variantIdx, layer["asset"]))
+                asset = (layerType, assets[layer["asset"]])
+                plan.assets.add(asset)
+                style = layer.get("style")
+                if style is not None:
+                    plan.styles.setdefault(asset, set()).add(style)
+                ops.append( ("asset", asset, style) )
+            elif layerType == "fg":
+                ops.append( ("fg", layer.get("focused", False), layer.get("row", 0.), layer.get("col", 0.)) )
+            else:
+                if layer["font"] not in fonts:
+                    raise ValueError("variant {}: unknown font {}".format(variantIdx, layer["font"]))
+                color = layer["color"]
+                # tagged here, an rgb color may also start with an int (e.g. [0, 0, 0])
+                color = ("style", color, layer.get("shade", 0)) if isinstance(color, int) else ("rgb",) + tuple(color)
+                ops.append( ("text", layer["text"], layer["font"], color, layer.get("row", 0.), layer.get("col", 0.), layer.get("anchor", "topleft")) )
+        plan.variants.append( (ops, variant["output"], tuple(variant["resize"]) if variant.get("resize") else None) )
+    return plan
+
+class RenderPlan:
+    """
+    Render plan compiled from a layout spec by compileLayout
+    The assets (and their domain colors) are read once for the whole batch
+    For each product, every (asset, style) used by any variant is rendered once, all the styles of an asset from one hsv conversion
+    """
+
+    def __init__(self, _factory):
+        """
+        Parameters
+        ----------
+        _factory: ImgFactory
+            The factory of the layout dimension
+        Returns
+        ----------
+        None
+        """
+        self.factory = _factory
+        self.fonts = {}
+        self.assets = set()
+        self.styles = {}
+        self.variants = []
+        self.spec = None
+        self._loaded = {}
+
+    def describe(self):
+        """
+        Returns
+        ----------
+        List
+            Containing a line per shared step of the plan, for inspection
+        """
+        lines = ["read {} {}".format(assetType, path) for assetType, path in sorted(self.assets)]
+        lines += ["render {} {} styles {}".format(assetType, path, sorted(styles)) for (assetType, path), styles in sorted(self.styles.items())]
+        lines += ["variant {}: {} layers => {}".format(idx, len(ops), output) for idx, (ops, output, _) in enumerate(self.variants)]
+        return lines
+
+    def run(self, _fgPaths, _dump = True, _variants = None, _renderCache = None):
+        """
+        Parameters
+        ----------
+        _fgPaths: list of string
+            Paths of the products (foreground/item files)
+        _dump: bool
+            Dump the variants to their output paths, otherwise only return the arrays
+        _variants: list of int
+            Indices of the variants to be rendered, all of them if None
+        _renderCache: rendercache.RenderCache
+            Optional cache of the dumped variants, keyed on the spec, the asset, font and product bytes and the variant
+            A product whose variants are up to date in its manifest (or cached) is not rendered, ignored if not _dump
+        Returns
+        ----------
+        List
+            Containing a list of (output path, numpy array) per product, in the order of _variants
+            The array is None for the variants served from _renderCache
+        """
+        factory = self.factory
+        cache = _renderCache if _dump else None
+        if cache is not None:
+            inputHashes = self._getInputHashes(cache)
+            planKey = cache.getKey("plan", self.spec, sorted(inputHashes.items()))
+        variantIdxs = range(len(self.variants)) if _variants is None else _variants
+        styles = {}
+        for variantIdx in variantIdxs:
+            for op in self.variants[variantIdx][0]:
+                if op[0] == "asset" and op[2] is not None:
+                    styles.setdefault(op[1], set()).add(op[2])
+        results = []
+        for productIdx, fgPath in enumerate(_fgPaths):
+            product = os.path.splitext(os.path.basename(fgPath))[0]
+            if cache is not None:
+                fgHash = cache.hashFile(fgPath)
+                keys = [cache.getKey("layout", planKey, fgHash, variantIdx) for variantIdx in variantIdxs]
+                outputPaths = [self.variants[variantIdx][1].format(product = product, index = productIdx, variant = variantIdx) for variantIdx in variantIdxs]
+                if all(cache.isFresh(outputPath, key) or cache.getFile(key, outputPath) for key, outputPath in zip(keys, outputPaths)):
+                    for key, outputPath in zip(keys, outputPaths):
+                        cache.record(outputPath, key, dict(inputHashes, **{fgPath: fgHash}))
+                    results.append([(outputPath, None) for outputPath in outputPaths])
+                    continue
+            # the assets are read by the first product that is not served from the cache
+            self.load()
+            fg = factory.readFg(fgPath)
+            fgDomain = factory.getDomainColor(fgPath)
+            focusedFg = None
+            rendered = {}
+            for asset, assetStyles in styles.items():
+                img, domain = self._loaded[asset]
+                assetStyles = sorted(assetStyles)
+                for style, renderedImg in zip(assetStyles, factory.renderImgs(img, domain, fgDomain, assetStyles)):
+                    rendered[(asset, style)] = renderedImg
+            outputs = []
+            for variantIdx in variantIdxs:
+                ops, output, resize = self.variants[variantIdx]
+                _, asset, style = ops[0]
+                img = factory.compositeImg(self._loaded[asset][0] if style is None else rendered[(asset, style)], [])
+                for op in ops[1:]:
+                    if op[0] == "asset":
+                        factory.compositeImg(img, [(self._loaded[op[1]][0] if op[2] is None else rendered[(op[1], op[2])], None, None)], img)
+                    elif op[0] == "fg":
+                        if op[1] and focusedFg is None:
+                            focusedFg = factory.getFocusedFg(fg) if factory.fgIndex is None else factory.readFocusedFg(fgPath)
+                        factory.compositeImg(img, [(focusedFg if op[1] else fg, op[2], op[3])], img)
+                    else:
+                        self._addText(img, op, fgDomain)
+                if resize is not None:
+                    img = factory.resizeImg(img, resize)
+                outputPath = output.format(product = product, index = productIdx, variant = variantIdx)
+                if _dump:
+                    factory.dumpImg(img, outputPath)
+                if cache is not None:
+                    cache.putFile(keys[len(outputs)], outputPath)
+                    cache.record(outputPath, keys[len(outputs)], dict(inputHashes, **{fgPath: fgHash}))
+                outputs.append( (outputPath, img) )
+            results.append(outputs)
+        if cache is not None:
+            cache.save()
+        return results
+
+    def _getInputHashes(self, _renderCache):
+        """
+        Hashes of the asset and font files of the plan, by path
+        """
+        paths = [path for _, path in self.assets] + [ttfPath for ttfPath, _ in self.fonts.values()]
+        return {path: _renderCache.hashFile(path) for path in paths}
+
+    def load(self):
+        """
+        Read the assets and their domain colors, once for all the runs
+        """
+        factory = self.factory
+        for asset in self.assets:
+            if asset not in self._loaded:
+                assetType, path = asset
+                self._loaded[asset] = ( getattr(factory, READERS[assetType])(path), factory.getDomainColor(path) )
+
+    def _addText(self, _imgArr, _op, _fgDomain):
+        """
+        Add the text of a text op onto _imgArr in place
+        """
+        factory = self.factory
+        _, text, fontName, color, row, col, anchor = _op
+        font = factory.getFont(*self.fonts[fontName])
+        if color[0] == "style":
+            color = factory.renderRGB(_fgDomain, color[1])[color[2]]
+        else:
+            color = color[1:]
+        if anchor == "center":
+            factory.addTextImg(_imgArr, factory.getTextImg(text, font, color), row, col, _imgArr)
+        else:
+            factory.addText(_imgArr, text, font, color, row, col, _imgArr)
@@ -0,0 +1,224 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from imgfactory import ImgFactory
+
+class RenderCache:
+    """
+    Content-addressed cache of encoded render outputs in a local directory, bounded by bytes with LRU eviction
+    The keys hash everything that determines an output (input bytes, dimension, style, highS, encoding) together with ImgFactory.PIPELINE_VERSION
+    The manifest (manifest.json in the directory) records which key and inputs produced each output file, so a rerun only renders the changed inputs
+    Lookups are safe from several processes, record and save are meant for the one process driving the batch
+    """
+
+    def __init__(self, _dirPath, _maxBytes = 1024 * 1024 * 1024):
+        """
+        Parameters
+        ----------
+        _dirPath: string
+            Directory of the cached outputs and the manifest, created if missing
+        _maxBytes: int
+            Max total bytes of the cached outputs, the least recently used ones are evicted by save
+        Returns
+        ----------
+        None
+        """
+        self.dirPath = _dirPath
+        self.maxBytes = _maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._manifest = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(_dirPath, "objects"), exist_ok = True)
+
+    def getKey(self, *_parts):
+        """
+        Parameters
+        ----------
+        _parts:
+            JSON-serializable parts of the key, e.g. (input hash, dimension, styleID, highS, extension)
+        Returns
+        ----------
+        string
+            The hex key, which also covers ImgFactory.PIPELINE_VERSION
+        """
+        return hashlib.sha256(json.dumps([ImgFactory.PIPELINE_VERSION] + list(_parts), sort_keys = True).encode("utf-8")).hexdigest()
+
+    def hashFile(self, _path):
+        """
+        Parameters
+        ----------
+        _path: string
+            Path of an input file
+        Returns
+        ----------
+        string
+            The hex sha256 of its bytes, memoized in the manifest per (path, mtime, size) so that unchanged inputs are not read again
+        """
+        path = os.path.abspath(_path)
+        stat = os.stat(path)
+        files = self._getManifest()["files"]
+        with self._lock:
+            memo = files.get(path)
+            if memo is not None and memo[0] == stat.st_mtime_ns and memo[1] == stat.st_size:
+                return memo[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as inputFile:
+            for chunk in iter(lambda: inputFile.read(1024 * 1024), b""):
+                digest.update(chunk)
+        with self._lock:
+            files[path] = [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def getFile(self, _key, _outputPath):
+        """
+        Parameters
+        ----------
+        _key: string
+            Key of the output, see getKey
+        _outputPath: string
+            Path the cached output is copied to
+        Returns
+        ----------
+        bool
+            Whether the key was cached (and copied)
+        """
+        objectPath = self._getObjectPath(_key)
+        try:
+            shutil.copyfile(objectPath, _outputPath)
+            os.utime(objectPath)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def putFile(self, _key, _path):
+        """
+        Parameters
+        ----------
+        _key: string
+            Key of the output, see getKey
+        _path: string
+            Path of the encoded output to be cached
+        Returns
+        ----------
+        None
+        """
+        objectPath = self._getObjectPath(_key)
+        os.makedirs(os.path.dirname(objectPath), exist_ok = True)
+        tmpPath = "{}.{}.tmp".format(objectPath, uuid.uuid4().hex)
+        shutil.copyfile(_path, tmpPath)
+        os.replace(tmpPath, objectPath)
+
+    def isFresh(self, _outputPath, _key):
+        """
+        Parameters
+        ----------
+        _outputPath: string
+            Path of an output file
+        _key: string
+            Key the output should have been produced with
+        Returns
+        ----------
+        bool
+            Whether the manifest records _outputPath with _key, and the file is still there with the recorded size
+        """
+        entry = self._getManifest()["outputs"].get(os.path.abspath(_outputPath))
+        if entry is None or entry["key"] != _key:
+            return False
+        try:
+            return os.path.getsize(_outputPath) == entry["size"]
+        except OSError:
+            return False
+
+    def record(self, _outputPath, _key, _inputs):
+        """
+        Parameters
+        ----------
+        _outputPath: string
+            Path of the produced output file
+        _key: string
+            Key it was produced with
+        _inputs: dict
+            Hash (see hashFile) of every input file it was produced from, by path
+        Returns
+        ----------
+        None
+        """
+        entry = {"key": _key, "size": os.path.getsize(_outputPath), "inputs": {os.path.abspath(path): digest for path, digest in _inputs.items()}}
+        outputs = self._getManifest()["outputs"]
+        with self._lock:
+            outputs[os.path.abspath(_outputPath)] = entry
+
+    def getOutputs(self, _inputPath):
+        """
+        Parameters
+        ----------
+        _inputPath: string
+            Path of an input file
+        Returns
+        ----------
+        List
+            Containing the recorded outputs produced from _inputPath
+        """
+        path = os.path.abspath(_inputPath)
+        return sorted(output for output, entry in self._getManifest()["outputs"].items() if path in entry["inputs"])
+
+    def save(self):
+        """
+        Write the manifest and evict the least recently used outputs above _maxBytes
+        Returns
+        ----------
+        int
+            Number of evicted outputs
+        """
+        manifestPath = os.path.join(self.dirPath, "manifest.json")
+        tmpPath = "{}.{}.tmp".format(manifestPath, uuid.uuid4().hex)
+        with self._lock:
+            with open(tmpPath, "w", encoding = "utf-8") as manifest:
+                json.dump(self._getManifest(), manifest, indent = 1, sort_keys = True)
+        os.replace(tmpPath, manifestPath)
+        objects = []
+        for dirPath, _, fileNames in os.walk(os.path.join(self.dirPath, "objects")):
+            for fileName in fileNames:
+                if not fileName.endswith(".tmp"):
+                    stat = os.stat(os.path.join(dirPath, fileName))
+                    objects.append( (stat.st_mtime, stat.st_size, os.path.join(dirPath, fileName)) )
+        total = sum(size for _, size, _ in objects)
+        evicted = 0
+        for _, size, objectPath in sorted(objects):
+            if total <= self.maxBytes:
+                break
+            os.remove(objectPath)
+            total -= size
+            evicted += 1
+        return evicted
+
+    def getStats(self):
+        """
+        Returns
+        ----------
+        Dict
+            Lookup hits and misses of this instance, and the number of outputs recorded in the manifest
+        """
+        return {"hits": self.hits, "misses": self.misses, "outputs": len(self._getManifest()["outputs"])}
+
+    def _getObjectPath(self, _key):
+        return os.path.join(self.dirPath, "objects", _key[:2], _key)
+
+    def _getManifest(self):
+        # loaded on first use, the worker processes only read and write objects
+        if self._manifest is None:
+            manifestPath = os.path.join(self.dirPath, "manifest.json")
+            manifest = {"files": {}, "outputs": {}}
+            if os.path.exists(manifestPath):
+                with open(manifestPath, encoding = "utf-8") as manifestFile:
+                    manifest = json.load(manifestFile)
+            self._manifest = manifest
+        return self._manifest
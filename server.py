@@ -0,0 +1,555 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import http.client
+import http.server
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+import PIL.Image
+from imgfactory import ImgFactory, AssetCache
+from layout import compileLayout
+
+CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp", ".bmp": "image/bmp"}
+
+# state of a warm worker process, set up once by _initWorker
+_worker = {}
+
+def _initWorker(_fonts, _layouts, _cacheBytes):
+    """
+    Initializer of the worker processes, loading the fonts and the layout assets before the first request
+    """
+    cache = AssetCache(_cacheBytes)
+    factory = ImgFactory((1, 1), (1, 1), _assetCache = cache)
+    for ttfPath, size in _fonts:
+        factory.getFont(ttfPath, size)
+    _worker["cache"] = cache
+    _worker["factories"] = {}
+    _worker["plans"] = {}
+    for name, spec in _layouts.items():
+        plan = compileLayout(spec, cache)
+        plan.load()
+        _worker["plans"][name] = plan
+
+def _getFactory(_bgDim, _fgDim):
+    key = (tuple(_bgDim), tuple(_fgDim))
+    if key not in _worker["factories"]:
+        _worker["factories"][key] = ImgFactory(key[0], key[1], _assetCache = _worker["cache"])
+    return _worker["factories"][key]
+
+def _getColor(_factory, _color):
+    # an (r, g, b) from 0.0 to 1.0, or the path of an image whose domain color is used
+    if _color is None:
+        return (0.0, 0.0, 0.0)
+    if isinstance(_color, str):
+        return _factory.getDomainColor(_color)
+    return tuple(_color)
+
+def _renderBatch(_kind, _requests):
+    """
+    Parameters
+    ----------
+    _kind: string
+        "render" or "layout", see getBatchKey
+    _requests: list of dict
+        Requests of the same batch key
+    Returns
+    ----------
+    Tuple
+        (a (True, encoded bytes) or (False, error message) per request, seconds spent in the worker)
+    """
+    start = time.perf_counter()
+    results = [None] * len(_requests)
+    groups = collections.OrderedDict()
+    for idx, request in enumerate(_requests):
+        if _kind == "render":
+            key = (request["path"], tuple(request.get("bgDim") or ()), json.dumps([request.get("domain"), request.get("target")]), bool(request.get("highS", False)))
+        else:
+            key = request["layout"]
+        groups.setdefault(key, []).append(idx)
+    for idxs in groups.values():
+        try:
+            imgs = (_renderGroup if _kind == "render" else _layoutGroup)([_requests[idx] for idx in idxs])
+            for idx, (factory, img) in zip(idxs, imgs):
+                request = _requests[idx]
+                results[idx] = (True, factory.encodeImg(img, request.get("ext", ".png"), request.get("quality"), request.get("compression")))
+        except Exception as error:
+            for idx in idxs:
+                results[idx] = (False, "{}: {}".format(type(error).__name__, error))
+    return results, time.perf_counter() - start
+
+def _renderGroup(_requests):
+    """
+    Recolor requests of the same source, read once and rendered from a single hsv conversion
+    """
+    first = _requests[0]
+    bgDim = first.get("bgDim")
+    if not bgDim:
+        w, h = PIL.Image.open(first["path"]).size
+        bgDim = (h, w)
+    factory = _getFactory(bgDim, first.get("fgDim") or bgDim)
+    img = factory.readBg(first["path"])
+    styles = sorted(set(request["style"] for request in _requests))
+    rendered = dict(zip(styles, factory.renderImgs(img, _getColor(factory, first.get("domain")), _getColor(factory, first.get("target")), styles, bool(first.get("highS", False)))))
+    imgs = []
+    for request in _requests:
+        img = rendered[request["style"]]
+        for text in request.get("texts", []):
+            img = factory.addText(img, text["text"], factory.getFont(*text["font"]), tuple(text["rgb"]), text.get("row", 0.), text.get("col", 0.))
+        imgs.append( (factory, img) )
+    return imgs
+
+def _layoutGroup(_requests):
+    """
+    Layout requests of the same plan, every product and variant rendered by one RenderPlan.run
+    """
+    plan = _worker["plans"][_requests[0]["layout"]]
+    fgPaths = list(dict.fromkeys(request["fg"] for request in _requests))
+    variants = sorted(set(request.get("variant", 0) for request in _requests))
+    outputs = plan.run(fgPaths, _dump = False, _variants = variants)
+    return [(plan.factory, outputs[fgPaths.index(request["fg"])][variants.index(request.get("variant", 0))][1]) for request in _requests]
+
+def getBatchKey(_request, _layouts):
+    """
+    Parameters
+    ----------
+    _request: dict
+        A recolor request {"path", "style", optional "bgDim", "fgDim", "domain", "target", "highS", "texts"}
+        or a layout request {"layout", "fg", optional "variant"}, both with optional "ext", "quality" and "compression"
+    _layouts: dict
+        The layout specs served, by name
+    Returns
+    ----------
+    Tuple
+        Key of the micro-batch, the requests of the same dimension (or layout) are sent to a worker together
+    """
+    if not isinstance(_request, dict):
+        raise ValueError("the request must be a JSON object")
+    _checkField(_request, "ext", str)
+    _checkField(_request, "quality", int)
+    _checkField(_request, "compression", int)
+    if str(_request.get("ext", ".png")).lower() not in CONTENT_TYPES:
+        raise ValueError("unsupported ext {}".format(_request.get("ext")))
+    if "layout" in _request:
+        _checkField(_request, "layout", str)
+        _checkField(_request, "fg", str)
+        _checkField(_request, "variant", int)
+        if _request["layout"] not in _layouts:
+            raise ValueError("unknown layout {}".format(_request["layout"]))
+        if "fg" not in _request:
+            raise ValueError("missing fg")
+        if not 0 <= _request.get("variant", 0) < len(_layouts[_request["layout"]]["variants"]):
+            raise ValueError("unknown variant {}".format(_request.get("variant")))
+        return ("layout", _request["layout"])
+    if "path" not in _request or not isinstance(_request.get("style"), int):
+        raise ValueError("a render request needs path and style")
+    _checkField(_request, "path", str)
+    _checkField(_request, "highS", bool)
+    for name in ("bgDim", "fgDim"):
+        dim = _request.get(name)
+        if dim and not (isinstance(dim, list) and len(dim) == 2 and all(isinstance(value, int) and value > 0 for value in dim)):
+            raise ValueError("{} must be [rows, cols]".format(name))
+    for name in ("domain", "target"):
+        color = _request.get(name)
+        if color is not None and not isinstance(color, str) and not _isRGB(color):
+            raise ValueError("{} must be [r, g, b] or an image path".format(name))
+    _checkField(_request, "texts", list)
+    for text in _request.get("texts", []):
+        if not isinstance(text, dict) or not isinstance(text.get("text"), str) or not _isRGB(text.get("rgb")):
+            raise ValueError("a text needs text and rgb")
+        font = text.get("font")
+        if not (isinstance(font, list) and len(font) == 2 and isinstance(font[0], str) and isinstance(font[1], int)):
+            raise ValueError("the font of a text must be [ttf path, size]")
+        _checkField(text, "row", (int, float))
+        _checkField(text, "col", (int, float))
+    # without bgDim, the dimension is the image size and only the requests of the same image are batched
+    return ("render", tuple(_request["bgDim"]) if _request.get("bgDim") else _request["path"], tuple(_request.get("fgDim") or ()))
+
+def _checkField(_request, _name, _types):
+    # a field of valid JSON but of the wrong type is a bad request, not a worker error
+    if _request.get(_name) is not None and not isinstance(_request[_name], _types):
+        raise ValueError("invalid {} {}".format(_name, json.dumps(_request[_name])))
+
+def _isRGB(_color):
+    return isinstance(_color, list) and len(_color) == 3 and all(isinstance(value, (int, float)) for value in _color)
+
+class ServerMetrics:
+    """
+    Queue depth, batching and latency metrics of a RenderServer
+    """
+
+    # number of recent latencies kept for the quantiles
+    WINDOW = 1024
+
+    def __init__(self):
+        """
+        Returns
+        ----------
+        None
+        """
+        self.queued = 0
+        self.inFlight = 0
+        self.requests = collections.Counter()
+        self.batches = 0
+        self.batchedRequests = 0
+        self.workerSeconds = 0.
+        self.latencySeconds = 0.
+        self._latencies = collections.deque(maxlen = ServerMetrics.WINDOW)
+        self._lock = threading.Lock()
+
+    def onSubmit(self):
+        with self._lock:
+            self.queued += 1
+
+    def onDispatch(self, _size):
+        with self._lock:
+            self.queued -= _size
+            self.inFlight += _size
+            self.batches += 1
+            self.batchedRequests += _size
+
+    def onDone(self, _latencies, _statuses, _workerSeconds):
+        with self._lock:
+            self.inFlight -= len(_latencies)
+            self.workerSeconds += _workerSeconds
+            self.latencySeconds += sum(_latencies)
+            self._latencies.extend(_latencies)
+            self.requests.update(_statuses)
+
+    def getSummary(self):
+        """
+        Returns
+        ----------
+        Dict
+            Current queue depth and in-flight requests, request and batch counters, and latency quantiles (seconds) of the recent requests
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+            return {
+                "queued": self.queued,
+                "inFlight": self.inFlight,
+                "requests": dict(self.requests),
+                "batches": self.batches,
+                "meanBatchSize": self.batchedRequests / max(self.batches, 1),
+                "workerSeconds": self.workerSeconds,
+                "latencySeconds": self.latencySeconds,
+                "latency": {str(q): float(np.quantile(latencies, q)) for q in (0.5, 0.9, 0.99)},
+            }
+
+    def toPrometheus(self, _prefix = "imgfactory_server"):
+        """
+        Parameters
+        ----------
+        _prefix: string
+            Prefix of the metric names
+        Returns
+        ----------
+        string
+            The metrics in the Prometheus text exposition format
+        """
+        summary = self.getSummary()
+        lines = []
+        for metric, metricType, help, values in (
+            ("queue_depth", "gauge", "Requests waiting for a worker", [("", summary["queued"])]),
+            ("in_flight", "gauge", "Requests being rendered by a worker", [("", summary["inFlight"])]),
+            ("requests_total", "counter", "Finished requests", [('{{status="{}"}}'.format(status), count) for status, count in sorted(summary["requests"].items())]),
+            ("batches_total", "counter", "Micro-batches sent to the workers", [("", summary["batches"])]),
+            ("worker_seconds_total", "counter", "Wall time of the workers rendering the batches", [("", summary["workerSeconds"])]),
+            ("latency_seconds", "summary", "Latency of the requests, from submission to the encoded image", [('{{quantile="{}"}}'.format(q), value) for q, value in summary["latency"].items()] + [("_sum", summary["latencySeconds"]), ("_count", sum(summary["requests"].values()))])):
+            lines.append("# HELP {}_{} {}".format(_prefix, metric, help))
+            lines.append("# TYPE {}_{} {}".format(_prefix, metric, metricType))
+            for suffix, value in values:
+                lines.append("{}_{}{} {}".format(_prefix, metric, suffix, value))
+        return "\n".join(lines) + "\n"
+
+class RenderServer:
+    """
+    Render service keeping warm worker processes, with the fonts and the layout assets loaded once
+    Concurrent requests of the same batch key (see getBatchKey) are grouped into micro-batches, so a batch of the same source is read once and rendered from one hsv conversion
+    """
+
+    def __init__(self, _workers = 2, _batchWindow = 0.005, _maxBatch = 16, _fonts = (), _layouts = None, _cacheBytes = 256 * 1024 * 1024):
+        """
+        Parameters
+        ----------
+        _workers: int
+            Number of worker processes
+        _batchWindow: double
+            Seconds to wait for more requests after the first one of a batch
+        _maxBatch: int
+            Max number of requests of a micro-batch
+        _fonts: list of (ttfPath, size)
+            Fonts loaded by every worker at start
+        _layouts: dict
+            Layout specs (see layout.compileLayout) by name, compiled and loaded by every worker at start
+        _cacheBytes: int
+            Size of the AssetCache of each worker
+        Returns
+        ----------
+        None
+        """
+        self.batchWindow = _batchWindow
+        self.maxBatch = _maxBatch
+        self.layouts = dict(_layouts or {})
+        self.metrics = ServerMetrics()
+        self._pool = multiprocessing.Pool(_workers, _initWorker, (list(_fonts), self.layouts, _cacheBytes))
+        # at most two batches per worker are handed to the pool, the rest waits in the queue
+        self._slots = threading.BoundedSemaphore(2 * _workers)
+        self._queue = queue.Queue()
+        self._dispatcher = threading.Thread(target = self._dispatch, daemon = True)
+        self._dispatcher.start()
+
+    def submit(self, _request):
+        """
+        Parameters
+        ----------
+        _request: dict
+            The request, see getBatchKey
+        Returns
+        ----------
+        Future
+            Resolved with the encoded image bytes, or a RuntimeError of the worker
+            Raises ValueError right away if the request is malformed
+        """
+        key = getBatchKey(_request, self.layouts)
+        future = concurrent.futures.Future()
+        self.metrics.onSubmit()
+        self._queue.put( (key, _request, future, time.perf_counter()) )
+        return future
+
+    def render(self, _request, _timeout = None):
+        """
+        Parameters
+        ----------
+        _request: dict
+            The request, see getBatchKey
+        _timeout: double
+            Seconds to wait, forever if None
+        Returns
+        ----------
+        bytes
+            The encoded image
+        """
+        return self.submit(_request).result(_timeout)
+
+    def close(self):
+        """
+        Stop the dispatcher and the workers, after the queued requests are done
+        """
+        self._queue.put(None)
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+
+    def _dispatch(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batches = collections.OrderedDict()
+            batches[item[0]] = [item]
+            deadline = time.perf_counter() + self.batchWindow
+            while max(len(items) for items in batches.values()) < self.maxBatch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batches.setdefault(item[0], []).append(item)
+            for key, items in batches.items():
+                self._slots.acquire()
+                self.metrics.onDispatch(len(items))
+                self._pool.apply_async(_renderBatch, (key[0], [item[1] for item in items]), callback = functools.partial(self._onDone, items), error_callback = functools.partial(self._onError, items))
+
+    def _onDone(self, _items, _result):
+        results, workerSeconds = _result
+        now = time.perf_counter()
+        self.metrics.onDone([now - item[3] for item in _items], ["ok" if ok else "error" for ok, _ in results], workerSeconds)
+        self._slots.release()
+        for item, (ok, data) in zip(_items, results):
+            if ok:
+                item[2].set_result(data)
+            else:
+                item[2].set_exception(RuntimeError(data))
+
+    def _onError(self, _items, _error):
+        now = time.perf_counter()
+        self.metrics.onDone([now - item[3] for item in _items], ["error"] * len(_items), 0.)
+        self._slots.release()
+        for item in _items:
+            item[2].set_exception(RuntimeError("{}: {}".format(type(_error).__name__, _error)))
+
+class RenderHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP front end of a RenderServer
+    POST /render with a JSON request (see getBatchKey) returns the encoded image
+    GET /metrics returns the ServerMetrics in the Prometheus format (JSON with ?format=json), GET /health returns "ok"
+    """
+
+    # set by serve, renderTimeout is the seconds a request waits for its render (not the socket timeout of the handler)
+    renderServer = None
+    renderTimeout = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, "text/plain", b"ok\n")
+        elif self.path == "/metrics":
+            self._reply(200, "text/plain; version=0.0.4", self.renderServer.metrics.toPrometheus().encode())
+        elif self.path == "/metrics?format=json":
+            self._reply(200, "application/json", json.dumps(self.renderServer.metrics.getSummary()).encode())
+        else:
+            self._reply(404, "text/plain", b"not found\n")
+
+    def do_POST(self):
+        if self.path != "/render":
+            self._reply(404, "text/plain", b"not found\n")
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            future = self.renderServer.submit(request)
+        except ValueError as error:
+            self._reply(400, "text/plain", "{}\n".format(error).encode())
+            return
+        try:
+            data = future.result(self.renderTimeout)
+        except concurrent.futures.TimeoutError:
+            self._reply(504, "text/plain", b"timeout\n")
+            return
+        except RuntimeError as error:
+            self._reply(422, "text/plain", "{}\n".format(error).encode())
+            return
+        self._reply(200, CONTENT_TYPES[request.get("ext", ".png").lower()], data)
+
+    def address_string(self):
+        # the client address of a unix socket is an empty string
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, _format, *args):
+        pass
+
+    def _reply(self, _status, _contentType, _body):
+        self.send_response(_status)
+        self.send_header("Content-Type", _contentType)
+        self.send_header("Content-Length", str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+class ThreadingTCPHTTPServer(http.server.ThreadingHTTPServer):
+    # concurrent requests are the point of micro-batching, keep their connections in the backlog
+    request_queue_size = 128
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a unix socket, for requestRender
+    """
+
+    def __init__(self, _socketPath, _timeout = None):
+        super().__init__("localhost", timeout = _timeout)
+        self.socketPath = _socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+def requestRender(_address, _request, _timeout = None):
+    """
+    Parameters
+    ----------
+    _address: string
+        "host:port" of the server, or the path of its unix socket
+    _request: dict
+        The request, see getBatchKey
+    _timeout: double
+        Seconds to wait, forever if None
+    Returns
+    ----------
+    Tuple
+        (HTTP status, response bytes), the encoded image if the status is 200
+    """
+    if os.path.exists(_address):
+        connection = UnixHTTPConnection(_address, _timeout)
+    else:
+        host, port = _address.rsplit(":", 1)
+        connection = http.client.HTTPConnection(host, int(port), timeout = _timeout)
+    try:
+        connection.request("POST", "/render", json.dumps(_request), {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def serve(_renderServer, _host = "127.0.0.1", _port = 8318, _unixSocket = None, _timeout = None):
+    """
+    Parameters
+    ----------
+    _renderServer: RenderServer
+        The server rendering the requests
+    _host, _port:
+        Address of the HTTP server, ignored if _unixSocket is set
+    _unixSocket: string
+        Path of a unix socket to listen on instead
+    _timeout: double
+        Seconds a request waits for its image before a 504, forever if None
+    Returns
+    ----------
+    socketserver.BaseServer
+        The HTTP server, run it with serve_forever
+    """
+    handler = type("BoundRenderHandler", (RenderHandler,), {"renderServer": _renderServer, "renderTimeout": _timeout})
+    if _unixSocket is not None:
+        if os.path.exists(_unixSocket):
+            os.remove(_unixSocket)
+        return ThreadingUnixHTTPServer(_unixSocket, handler)
+    return ThreadingTCPHTTPServer((_host, _port), handler)
+
+if __name__ == "__main__":
+
+    # read input from command line arg
+    parser = argparse.ArgumentParser(description = "Colorful Image Render Server", formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--host", default = "127.0.0.1", help = "Address to listen on")
+    parser.add_argument("--port", type = int, default = 8318, help = "Port to listen on")
+    parser.add_argument("--unix", help = "Listen on this unix socket instead of host:port")
+    parser.add_argument("--workers", type = int, default = 2, help = "Number of warm worker processes")
+    parser.add_argument("--batch-window", type = float, default = 5., help = "Milliseconds to wait for more requests of a micro-batch")
+    parser.add_argument("--max-batch", type = int, default = 16, help = "Max number of requests of a micro-batch")
+    parser.add_argument("--font", nargs = 2, action = "append", default = [], metavar = ("TTF", "SIZE"), help = "Font loaded by the workers at start, can be repeated")
+    parser.add_argument("--layout", action = "append", default = [], metavar = "NAME=SPEC", help = "Layout spec JSON served as NAME, can be repeated")
+    parser.add_argument("--cache-mb", type = int, default = 256, help = "Asset cache size of each worker")
+    parser.add_argument("--timeout", type = float, help = "Seconds a request waits before a 504")
+    args = parser.parse_args()
+
+    layouts = {}
+    for entry in args.layout:
+        name, specPath = entry.split("=", 1)
+        with open(specPath, encoding = "utf-8") as spec:
+            layouts[name] = json.load(spec)
+    renderServer = RenderServer(args.workers, args.batch_window / 1000, args.max_batch, [(ttfPath, int(size)) for ttfPath, size in args.font], layouts, args.cache_mb * 1024 * 1024)
+    httpServer = serve(renderServer, args.host, args.port, args.unix, args.timeout)
+    print("serving on {}".format(args.unix or "{}:{}".format(args.host, args.port)))
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpServer.server_close()
+        renderServer.close()